@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+
+# Benchmark the orchestrator overhead: runs pyrunner.main() against synthetic
+# module trees with a fake terraform binary on PATH, no AWS access needed.
+#
+#   cd terraform/aws
+#   python3 benchmarks/bench_orchestrator.py --modules 10,100,500 --modes serial,concurrent
+import argparse
+import json
+import os
+import random
+import shutil
+import stat
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.realpath(__file__))
+BUILD_DIR = os.path.dirname(BENCH_DIR)
+if BUILD_DIR not in sys.path:
+  sys.path.insert(0, BUILD_DIR)
+
+BENCH_WORKSPACE = "dev"
+
+# fake terraform processes timed to estimate the cost of one spawn
+SPAWN_SAMPLES = 5
+
+# runs pyrunner.main() in a process of its own, so CPU and peak RSS are the ones of
+# a single row, and writes them to the file given as first argument
+RUNNER = '''
+import contextlib, io, json, resource, sys, time
+result_file, build_dir = sys.argv[1:3]
+sys.path.insert(0, build_dir)
+import pyrunner
+sys.argv = ["pyrunner.py"] + sys.argv[3:]
+output = io.StringIO()
+exit_code = 0
+started = time.perf_counter()
+with contextlib.redirect_stdout(output):
+  try:
+    pyrunner.main()
+  except SystemExit as exc:
+    exit_code = exc.code or 0
+wall = time.perf_counter() - started
+usage = resource.getrusage(resource.RUSAGE_SELF)
+children = resource.getrusage(resource.RUSAGE_CHILDREN)
+with open(result_file, "w") as f:
+  json.dump({"exit_code": exit_code, "wall_time": wall, "cpu": usage.ru_utime + usage.ru_stime,
+             "peak_rss_kb": usage.ru_maxrss, "child_peak_rss_kb": children.ru_maxrss,
+             "output_lines": output.getvalue().count("\\n")}, f)
+'''
+
+REMOTE_STATE_TEMPLATE = '''
+data "terraform_remote_state" "{name}" {{
+  backend = "s3"
+
+  config = {{
+    bucket         = lookup(var.envs[terraform.workspace], "bucket")
+    key            = format("env:/%s/%s/%s", terraform.workspace, "{name}", "terraform.tfstate")
+    region         = lookup(var.envs[terraform.workspace], "bucket_region")
+    dynamodb_table = lookup(var.envs[terraform.workspace], "dynamodb")
+  }}
+}}
+'''
+
+
+def process_arguments():
+  parser = argparse.ArgumentParser(description="pyrunner orchestrator benchmark")
+  parser.add_argument('--modules', default='10,50', help='Comma separated synthetic tree sizes')
+  parser.add_argument('--modes', default='serial,concurrent', help='Comma separated modes: serial, concurrent')
+  parser.add_argument('--action', default='plan', help='Terraform action to run')
+  parser.add_argument('--fanin', type=int, default=2, help='Maximum upstream modules per module')
+  parser.add_argument('--sleep', type=float, default=0.05, help='Seconds a fake plan/apply takes')
+  parser.add_argument('--output-lines', type=int, default=20, help='Lines printed by a fake plan/apply')
+  parser.add_argument('--memory-mb', type=float, default=0, help='Memory touched by a fake plan/apply')
+  parser.add_argument('--fail-rate', type=float, default=0, help='Probability a fake plan/apply fails')
+  parser.add_argument('--changes', default='1,0,0', help='"add,change,destroy" counts every fake plan reports')
+  parser.add_argument('--max-workers', type=int, default=None, help='Passed on to pyrunner')
+  parser.add_argument('--seed', type=int, default=1, help='Seed of the synthetic dependency graph')
+  parser.add_argument('--json', default=None, metavar='FILE', help='Also write the results to FILE')
+  return parser.parse_args()
+
+
+def make_tree(root, count, fanin, seed):
+  """
+  Create a build directory with `count` synthetic modules wired together
+  through terraform_remote_state, each reading up to `fanin` earlier ones
+  :return: (module paths, dict of module -> upstream modules)
+  """
+  rng = random.Random(seed)
+  shutil.copytree(os.path.join(BUILD_DIR, "variables"), os.path.join(root, "variables"))
+  os.makedirs(os.path.join(root, "modules"))
+
+  modules = []
+  deps = {}
+  for i in range(count):
+    name = f"mod-{i:04d}"
+    module_path = f"./main/synthetic/{name}"
+    upstreams = rng.sample(modules, min(len(modules), rng.randint(0, fanin)))
+    os.makedirs(os.path.join(root, module_path))
+    with open(os.path.join(root, module_path, "main.tf"), 'w') as f:
+      f.write(f'resource "null_resource" "{name}" {{}}\n')
+      for upstream in upstreams:
+        f.write(REMOTE_STATE_TEMPLATE.format(name=upstream.split('/')[-1]))
+    modules.append(module_path)
+    deps[module_path] = upstreams
+
+  with open(os.path.join(root, "deploy.yaml"), 'w') as f:
+    f.write(f"workspace:\n  - {BENCH_WORKSPACE}:\n      modules:\n")
+    for module_path in modules:
+      f.write(f"        - {module_path}\n")
+  return modules, deps
+
+
+def fake_terraform_bin(root):
+  """
+  The fake terraform, every call is logged with its working directory to <root>/calls.log
+  :return: (directory to put on PATH, path of the call log)
+  """
+  bin_dir = os.path.join(root, "bin")
+  os.makedirs(bin_dir)
+  calls_log = os.path.join(root, "calls.log")
+  terraform = os.path.join(bin_dir, "terraform")
+  with open(terraform, 'w') as f:
+    f.write(f"#!/bin/sh\necho \"$PWD\" >> \"{calls_log}\"\n"
+            f"exec \"{sys.executable}\" \"{os.path.join(BENCH_DIR, 'fake_terraform.py')}\" \"$@\"\n")
+  os.chmod(terraform, os.stat(terraform).st_mode | stat.S_IEXEC)
+  return bin_dir, calls_log
+
+
+def spawn_cost(bin_dir, env):
+  """
+  Median wall time of a fake terraform call doing no work
+  """
+  samples = []
+  with tempfile.TemporaryDirectory() as work_dir:
+    for _ in range(SPAWN_SAMPLES):
+      started = time.perf_counter()
+      subprocess.run([os.path.join(bin_dir, "terraform"), "version"], cwd=work_dir, env=env,
+                     stdout=subprocess.DEVNULL, check=True)
+      samples.append(time.perf_counter() - started)
+  return statistics.median(samples)
+
+
+def module_calls(calls_log, root, modules):
+  """
+  :return: dict of module -> number of terraform processes it ran
+  """
+  calls = dict((m, 0) for m in modules)
+  if os.path.exists(calls_log):
+    with open(calls_log, 'r') as f:
+      for line in f:
+        module_path = "./" + os.path.relpath(line.strip(), os.path.realpath(root))
+        if module_path in calls:
+          calls[module_path] += 1
+  return calls
+
+
+def ideal_makespan(modules, deps, work, workers):
+  """
+  Lower bound of the wall time: the longest dependency chain, or all the
+  work spread evenly over the workers, whichever is larger
+  :param work: dict of module -> seconds it takes at least
+  """
+  finish = {}
+  for module_path in modules:
+    finish[module_path] = work[module_path] + max([finish[u] for u in deps[module_path]] or [0])
+  critical_path = max(finish.values()) if finish else 0
+  return max(critical_path, sum(work.values()) / workers)
+
+
+def bench(args, count, mode):
+  root = tempfile.mkdtemp(prefix="pyrunner-bench-")
+  try:
+    modules, deps = make_tree(root, count, args.fanin, args.seed)
+    bin_dir, calls_log = fake_terraform_bin(root)
+    env = dict(os.environ)
+    env["PATH"] = bin_dir + os.pathsep + env["PATH"]
+    env["FAKE_TF_SLEEP"] = str(args.sleep)
+    env["FAKE_TF_OUTPUT_LINES"] = str(args.output_lines)
+    env["FAKE_TF_MEMORY_MB"] = str(args.memory_mb)
+    env["FAKE_TF_FAIL_RATE"] = str(args.fail_rate)
+    env["FAKE_TF_CHANGES"] = args.changes
+    env["TF_PLUGIN_CACHE_DIR"] = os.path.join(root, "plugin-cache")
+    spawn = spawn_cost(bin_dir, env)
+
+    argv = ["-d", "true", "-t", args.action, "-a", "true", "-w", BENCH_WORKSPACE,
+            "-c", "true" if mode == "concurrent" else "false", "--keep-going"]
+    if args.max_workers:
+      argv += ["--max-workers", str(args.max_workers)]
+
+    result_file = os.path.join(root, "result.json")
+    subprocess.run([sys.executable, "-c", RUNNER, result_file, BUILD_DIR] + argv, cwd=root, env=env, check=True)
+    with open(result_file, 'r') as f:
+      run = json.load(f)
+    calls = module_calls(calls_log, root, modules)
+  finally:
+    shutil.rmtree(root, ignore_errors=True)
+
+  from buildscripts.tfresources import default_max_workers
+  workers = 1 if mode == "serial" else (args.max_workers or default_max_workers())
+  # the apply is skipped when the plan has no changes
+  has_changes = any(int(c) for c in args.changes.split(','))
+  steps = 2 if args.action.startswith("apply") and has_changes else 1
+  # every terraform process of a module (init, workspace, plan, show...) costs a spawn
+  work = dict((m, args.sleep * steps + calls[m] * spawn) for m in modules)
+  ideal = ideal_makespan(modules, deps, work, workers)
+  return {
+    "modules": count,
+    "mode": mode,
+    "exit_code": run["exit_code"],
+    "wall_time": run["wall_time"],
+    "orchestrator_cpu": run["cpu"],
+    "orchestrator_peak_rss_mb": run["peak_rss_kb"] / 1024,
+    "child_peak_rss_mb": run["child_peak_rss_kb"] / 1024,
+    "spawn_time": spawn,
+    "terraform_calls": sum(calls.values()),
+    "ideal_wall_time": ideal,
+    "scheduling_efficiency": ideal / run["wall_time"] if run["wall_time"] else 0,
+    "output_lines": run["output_lines"]
+  }
+
+
+def main():
+  args = process_arguments()
+  results = []
+  print(f"{'modules':>8} {'mode':>11} {'wall s':>8} {'ideal s':>8} {'eff':>6} {'cpu s':>7} {'rss MB':>7} {'exit':>5}")
+  for count in [int(c) for c in args.modules.split(',')]:
+    for mode in args.modes.split(','):
+      result = bench(args, count, mode)
+      results.append(result)
+      print(f"{count:>8} {mode:>11} {result['wall_time']:>8.2f} {result['ideal_wall_time']:>8.2f} "
+            f"{result['scheduling_efficiency']:>6.2f} {result['orchestrator_cpu']:>7.2f} "
+            f"{result['orchestrator_peak_rss_mb']:>7.1f} {result['exit_code']:>5}")
+
+  if args.json:
+    with open(args.json, 'w') as f:
+      json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+# Startup budget of the CLI: imports pyrunner with `python -X importtime` and
+# fails when the cumulative import time goes over budget or when a module
+# that only some code paths need gets imported eagerly again.
+#
+#   cd terraform/aws
+#   python3 benchmarks/bench_startup.py --budget-ms 250
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.realpath(__file__))
+BUILD_DIR = os.path.dirname(BENCH_DIR)
+
+# only imported by the code paths that use them
+LAZY_MODULES = ["boto3", "botocore", "hcl2", "ruamel.yaml", "iterfzf"]
+
+
+def process_arguments():
+  parser = argparse.ArgumentParser(description="pyrunner startup benchmark")
+  parser.add_argument('--budget-ms', type=float, default=250, help='Maximum cumulative import time of pyrunner')
+  parser.add_argument('--runs', type=int, default=5, help='Number of runs, the median is checked against the budget')
+  parser.add_argument('--json', default=None, metavar='FILE', help='Also write the results to FILE')
+  return parser.parse_args()
+
+
+def import_times():
+  """
+  Import pyrunner in a fresh interpreter
+  :return: dict of module -> cumulative import time in microseconds
+  """
+  proc = subprocess.run([sys.executable, "-X", "importtime", "-c", "import pyrunner"],
+                        cwd=BUILD_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                        universal_newlines=True, check=True)
+  times = {}
+  for line in proc.stderr.splitlines():
+    if not line.startswith("import time:") or "cumulative" in line:
+      continue
+    _, cumulative, module = line[len("import time:"):].split("|")
+    times[module.strip()] = int(cumulative)
+  return times
+
+
+def help_wall_time():
+  started = time.perf_counter()
+  subprocess.run([sys.executable, "pyrunner.py", "--help"], cwd=BUILD_DIR,
+                 stdout=subprocess.DEVNULL, check=True)
+  return time.perf_counter() - started
+
+
+def main():
+  args = process_arguments()
+  runs = [import_times() for _ in range(args.runs)]
+  import_ms = statistics.median(r.get("pyrunner", 0) for r in runs) / 1000
+  help_s = statistics.median(help_wall_time() for _ in range(args.runs))
+  eager = sorted(m for m in runs[0] if m.split('.')[0] in LAZY_MODULES or m in LAZY_MODULES)
+  slowest = sorted(runs[0].items(), key=lambda i: i[1], reverse=True)[1:11]
+
+  print(f"pyrunner import: {import_ms:.1f} ms (budget {args.budget_ms:.0f} ms)")
+  print(f"pyrunner --help: {help_s * 1000:.1f} ms")
+  print("slowest imports (cumulative):")
+  for module, usec in slowest:
+    print(f"  {usec / 1000:>8.1f} ms  {module}")
+
+  if args.json:
+    with open(args.json, 'w') as f:
+      json.dump({"import_ms": import_ms, "help_s": help_s, "eager_imports": eager}, f, indent=2)
+
+  failed = False
+  if eager:
+    print(f"FAIL: imported at startup: {', '.join(eager)}")
+    failed = True
+  if import_ms > args.budget_ms:
+    print("FAIL: import time over budget")
+    failed = True
+  exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+# Stand-in for the terraform binary used by the orchestrator benchmarks.
+# Behaviour is controlled through environment variables:
+#   FAKE_TF_SLEEP         seconds plan/apply take (default 0.05)
+#   FAKE_TF_INIT_SLEEP    seconds init takes (default 0)
+#   FAKE_TF_OUTPUT_LINES  lines printed by plan/apply (default 20)
+#   FAKE_TF_MEMORY_MB     memory touched while planning/applying (default 0)
+#   FAKE_TF_FAIL_RATE     probability a plan/apply fails (default 0)
+#   FAKE_TF_SEED          seed for the failures, mixed with the working directory
+#   FAKE_TF_CHANGES       "add,change,destroy" counts every plan reports (default no changes)
+import json
+import os
+import random
+import sys
+import time
+
+
+def env_float(name, default):
+  return float(os.getenv(name, default))
+
+
+def work(command):
+  memory = bytearray(int(env_float("FAKE_TF_MEMORY_MB", 0) * 1024 * 1024))
+  for i in range(0, len(memory), 4096):
+    memory[i] = 1
+
+  lines = int(env_float("FAKE_TF_OUTPUT_LINES", 20))
+  for i in range(lines):
+    print(f"fake {command}: resource.synthetic[{i}] will be read during {command}")
+  sys.stdout.flush()
+  time.sleep(env_float("FAKE_TF_SLEEP", 0.05))
+
+  rng = random.Random(f"{os.getenv('FAKE_TF_SEED', '0')}:{os.getcwd()}:{command}")
+  if rng.random() < env_float("FAKE_TF_FAIL_RATE", 0):
+    print(f"Error: fake {command} failure", file=sys.stderr)
+    sys.exit(1)
+
+
+def plan_changes():
+  add, change, destroy = [int(c) for c in (os.getenv("FAKE_TF_CHANGES") or "0,0,0").split(',')]
+  return [["create"]] * add + [["update"]] * change + [["delete"]] * destroy
+
+
+def main(args):
+  command = args[0] if args else ""
+
+  if command == "init":
+    os.makedirs(".terraform", exist_ok=True)
+    time.sleep(env_float("FAKE_TF_INIT_SLEEP", 0))
+    print("Terraform has been successfully initialized!")
+  elif command == "workspace":
+    print(f"Switched to workspace \"{args[-1]}\".")
+  elif command == "plan":
+    work("plan")
+    if "-out" in args:
+      with open(args[args.index("-out") + 1], 'w') as f:
+        f.write("fake plan\n")
+    if "-detailed-exitcode" in args:
+      sys.exit(2 if plan_changes() else 0)
+  elif command == "apply":
+    work("apply")
+  elif command == "show":
+    resource_changes = [{"address": f"null_resource.synthetic[{i}]", "change": {"actions": actions}}
+                        for i, actions in enumerate(plan_changes())]
+    print(json.dumps({"format_version": "1.0", "resource_changes": resource_changes}))
+  elif command in ("fmt", "validate", "version"):
+    print(f"fake {command}: ok")
+  else:
+    print(f"fake terraform: unsupported command {' '.join(args)}", file=sys.stderr)
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
@@ -0,0 +1,87 @@
+import subprocess
+
+from .tfgraph import module_state_name
+
+# files every module links or copies in, a change here touches all of them
+SHARED_DIRS = ["variables/"]
+
+
+class GitDiffError(Exception):
+  """
+  Raised when the changed files can't be worked out with git
+  """
+
+
+def changed_files(base, branch=None):
+  """
+  Files changed on the branch since it forked from base, relative to the
+  build directory (files outside of it are left out)
+  :param base: base ref, e.g. origin/main
+  :param branch: merge request branch, defaults to HEAD
+  :return: list of changed file paths
+  """
+  args = ["git", "diff", "--name-only", "--relative", "--no-renames", f"{base}...{branch or 'HEAD'}"]
+  proc = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+  if proc.returncode != 0:
+    raise GitDiffError(f"{' '.join(args)}: {proc.stderr.strip()}")
+  return [line for line in proc.stdout.splitlines() if line]
+
+
+def _under(file_path, dir_path):
+  return file_path.startswith(dir_path.replace('./', '', 1).rstrip('/') + '/')
+
+
+def modules_touched(files, index):
+  """
+  Modules directly touched by the changed files: files in the module itself,
+  in a local module it sources or in the shared variables
+  :param files: changed file paths relative to the build directory
+  :param index: module index, dict of module path -> metadata with sources
+  :return: set of module paths
+  """
+  touched = set()
+  for file_path in files:
+    if any(file_path.startswith(d) for d in SHARED_DIRS):
+      return set(index)
+    for module_path, metadata in index.items():
+      if _under(file_path, module_path) or any(_under(file_path, s) for s in metadata["sources"]):
+        touched.add(module_path)
+  return touched
+
+
+def add_consumers(modules, index, workspace):
+  """
+  Add every module reading the state of one of the modules through
+  terraform_remote_state, transitively
+  :param modules: set of module paths
+  :param index: module index, dict of module path -> metadata with remote_states
+  :param workspace: the workspace the modules are run in
+  :return: set of module paths including the downstream consumers
+  """
+  consumers = {}
+  for module_path, metadata in index.items():
+    for ref_workspace, state_name in metadata["remote_states"]:
+      if ref_workspace is None or ref_workspace == workspace:
+        consumers.setdefault(state_name, set()).add(module_path)
+
+  affected = set(modules)
+  pending = list(modules)
+  while pending:
+    for consumer in consumers.get(module_state_name(pending.pop()), ()):
+      if consumer not in affected:
+        affected.add(consumer)
+        pending.append(consumer)
+  return affected
+
+
+def affected_modules(files, index, workspace, modules):
+  """
+  The modules of a workspace that a change can affect
+  :param files: changed file paths relative to the build directory
+  :param index: module index, dict of module path -> metadata
+  :param workspace: the workspace the modules are run in
+  :param modules: modules deployed to the workspace
+  :return: the affected modules, in the deploy order
+  """
+  affected = add_consumers(modules_touched(files, index), index, workspace)
+  return [m for m in modules if m in affected]
@@ -0,0 +1,170 @@
+import hashlib
+import json
+import os
+import re
+import threading
+
+from .tfgraph import parse_module_sources
+
+# orchestrator managed files live under the build directory (terraform/aws)
+PYRUNNER_DIR     = ".pyrunner"
+PLUGIN_CACHE_DIR = os.path.join(PYRUNNER_DIR, "plugin-cache")
+RESULTS_DIR      = os.path.join(PYRUNNER_DIR, "cache")
+FINGERPRINT_FILE = os.path.join(".terraform", "pyrunner-backend.sha256")
+LOCK_FILE        = ".terraform.lock.hcl"
+
+# files written into a module directory by run_module() itself
+GENERATED_FILES  = ["plan.out", "backend_override.tf", "providers_override.tf"]
+
+RESULTS_LOCK = threading.Lock()
+
+# module/provider requirements that need a re-init when they change
+REQUIREMENT_RE = re.compile(r'^\s*(source|version)\s*=\s*"[^"]*"', re.MULTILINE)
+
+
+def setup_plugin_cache():
+  """
+  Share one provider plugin cache between every terraform process spawned by
+  the orchestrator, unless the user already set TF_PLUGIN_CACHE_DIR
+  :return: the plugin cache directory
+  """
+  cache_dir = os.getenv("TF_PLUGIN_CACHE_DIR", None)
+  if cache_dir is None:
+    cache_dir = os.path.abspath(PLUGIN_CACHE_DIR)
+    os.environ["TF_PLUGIN_CACHE_DIR"] = cache_dir
+  os.makedirs(cache_dir, exist_ok=True)
+  return cache_dir
+
+
+def _hash_file(digest, file_path):
+  digest.update(file_path.encode())
+  if os.path.exists(file_path):
+    with open(file_path, 'rb') as f:
+      digest.update(f.read())
+  else:
+    digest.update(b"<missing>")
+
+
+def backend_fingerprint(module_dir, backend_config, override_files):
+  """
+  Fingerprint everything `terraform init` depends on for a module
+  :param module_dir: the module directory
+  :param backend_config: list of backend config "name=value" strings
+  :param override_files: backend/providers override files copied into the module
+  :return: hex digest
+  """
+  digest = hashlib.sha256()
+  for config in sorted(backend_config):
+    digest.update(config.encode() + b"\0")
+  for file_path in override_files:
+    _hash_file(digest, file_path)
+  _hash_file(digest, os.path.join(module_dir, LOCK_FILE))
+
+  # module sources and provider versions declared by the module itself
+  for name in sorted(os.listdir(module_dir)):
+    file_path = os.path.join(module_dir, name)
+    if name.endswith('.tf') and not os.path.islink(file_path):
+      with open(file_path, 'r') as tf_file:
+        for match in REQUIREMENT_RE.finditer(tf_file.read()):
+          digest.update(match.group(0).strip().encode() + b"\0")
+  return digest.hexdigest()
+
+
+def read_fingerprint(module_dir):
+  """
+  :return: the fingerprint recorded by the last successful init, or None
+  """
+  file_path = os.path.join(module_dir, FINGERPRINT_FILE)
+  if not os.path.exists(file_path):
+    return None
+  with open(file_path, 'r') as f:
+    return f.read().strip()
+
+
+def write_fingerprint(module_dir, fingerprint):
+  """
+  Record the fingerprint after a successful init. It is stored inside
+  .terraform so wiping the directory also forgets it.
+  """
+  file_path = os.path.join(module_dir, FINGERPRINT_FILE)
+  os.makedirs(os.path.dirname(file_path), exist_ok=True)
+  with open(file_path, 'w') as f:
+    f.write(fingerprint + "\n")
+
+
+def _hash_tree(digest, path):
+  for root, dirs, files in os.walk(path):
+    dirs[:] = sorted(d for d in dirs if d != ".terraform")
+    for name in sorted(files):
+      file_path = os.path.join(root, name)
+      # init writes the lock file when none is checked in, the provider
+      # requirements it follows are hashed with the .tf files
+      if name in GENERATED_FILES or name == LOCK_FILE or os.path.islink(file_path):
+        continue
+      _hash_file(digest, file_path)
+
+
+def module_input_hash(module_dir, input_files, upstream_states):
+  """
+  Hash everything a module run depends on: the module sources (without the
+  lock file, see _hash_tree, but with the local modules it calls), the linked
+  variables and override files, and the serials of the remote states it reads
+  :param module_dir: the module directory
+  :param input_files: variables/override files the module is run with
+  :param upstream_states: dict of remote state key -> "<lineage>:<serial>"
+  :return: hex digest, or None if an upstream state serial is unknown
+  """
+  if None in upstream_states.values():
+    return None
+
+  digest = hashlib.sha256()
+  _hash_tree(digest, module_dir)
+  for source_dir in parse_module_sources(module_dir):
+    _hash_tree(digest, source_dir)
+  for file_path in input_files:
+    _hash_file(digest, file_path)
+  for key in sorted(upstream_states):
+    digest.update(f"{key}={upstream_states[key]}".encode() + b"\0")
+  return digest.hexdigest()
+
+
+def _results_file(workspace):
+  return os.path.join(RESULTS_DIR, f"results-{workspace}.json")
+
+
+def _load_results(workspace):
+  file_path = _results_file(workspace)
+  if not os.path.exists(file_path):
+    return {}
+  with open(file_path, 'r') as f:
+    try:
+      return json.load(f)
+    except ValueError:
+      return {}
+
+
+def cached_result(workspace, tfaction, module_path, input_hash):
+  """
+  :return: True when the last successful run of this action for the module in
+           this workspace was done with the same inputs
+  """
+  if input_hash is None:
+    return False
+  with RESULTS_LOCK:
+    return _load_results(workspace).get(f"{tfaction}|{module_path}") == input_hash
+
+
+def record_result(workspace, tfaction, module_path, input_hash):
+  """
+  Remember the inputs of a successful run that left no changes pending
+  """
+  if input_hash is None:
+    return
+  with RESULTS_LOCK:
+    results = _load_results(workspace)
+    results[f"{tfaction}|{module_path}"] = input_hash
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    tmp_file = _results_file(workspace) + ".tmp"
+    with open(tmp_file, 'w') as f:
+      json.dump(results, f, indent=2, sort_keys=True)
+    os.replace(tmp_file, _results_file(workspace))
@@ -0,0 +1,126 @@
+import hashlib
+import json
+import os
+import threading
+
+from .tfcache import RESULTS_DIR
+
+# bump when the parsed layout changes so old sidecars are ignored
+CONFIG_CACHE_VERSION = 1
+
+CONFIG_LOCK = threading.Lock()
+
+# parsed files of this process, keyed by path -> (mtime_ns, size, data)
+parsed_configs = {}
+
+
+class Workspace:
+  """
+  One workspace/account of variables/_envs.tf
+  """
+  __slots__ = ("name", "account_id", "account", "region", "bucket", "bucket_region", "dynamodb",
+               "workspace_iam_role", "settings")
+
+  def __init__(self, name, settings):
+    """
+    :param name: terraform workspace
+    :param settings: the workspace map of the envs variable
+    """
+    self.name = name
+    self.account_id = settings.get("account_id")
+    self.account = settings.get("account")
+    self.region = settings.get("region")
+    self.bucket = settings.get("bucket")
+    self.bucket_region = settings.get("bucket_region")
+    self.dynamodb = settings.get("dynamodb")
+    self.workspace_iam_role = settings.get("workspace_iam_role")
+    self.settings = settings
+
+  def describe(self):
+    """
+    :return: the "workspace|account id|account" line shown in the account prompt
+    """
+    return f"{self.name}|{self.account_id}|{self.account}"
+
+  def __repr__(self):
+    return f"Workspace({self.name!r}, {self.account_id!r})"
+
+
+def _sidecar_path(path):
+  digest = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:12]
+  return os.path.join(RESULTS_DIR, f"config-{os.path.basename(path)}-{digest}.json")
+
+
+def load_cached(path, parser):
+  """
+  Parse a config file once: the result is memoized in the process and kept in
+  a JSON sidecar, both keyed by the file path, mtime and size
+  :param path: the config file
+  :param parser: callable parsing an open file into JSON serialisable data
+  :return: the parsed data
+  """
+  stat = os.stat(path)
+  key = [CONFIG_CACHE_VERSION, os.path.abspath(path), stat.st_mtime_ns, stat.st_size]
+
+  with CONFIG_LOCK:
+    cached = parsed_configs.get(path)
+    if cached is not None and cached[0] == key:
+      return cached[1]
+
+    sidecar = _sidecar_path(path)
+    data = None
+    try:
+      with open(sidecar, 'r') as f:
+        entry = json.load(f)
+      if entry.get("key") == key:
+        data = entry["data"]
+    except (OSError, ValueError, KeyError):
+      pass
+
+    if data is None:
+      with open(path, 'r') as f:
+        data = parser(f)
+      os.makedirs(RESULTS_DIR, exist_ok=True)
+      tmp_file = f"{sidecar}.{os.getpid()}.tmp"
+      with open(tmp_file, 'w') as f:
+        json.dump({"key": key, "data": data}, f, separators=(',', ':'))
+      os.replace(tmp_file, sidecar)
+
+    parsed_configs[path] = (key, data)
+    return data
+
+
+def _parse_envs(envs_file):
+  import hcl2
+
+  envs = hcl2.load(envs_file)['variable'][0]['envs']['default']
+  # older python-hcl2 releases wrap every map in a single element list
+  if isinstance(envs, list):
+    merged = {}
+    for entry in envs:
+      merged.update(entry)
+    envs = merged
+  return envs
+
+
+def _parse_yaml(yaml_file):
+  from ruamel.yaml import YAML
+
+  return YAML(typ='safe').load(yaml_file)
+
+
+def load_workspaces(envs_file):
+  """
+  The workspaces of the envs variable in variables/_envs.tf
+  :param envs_file: path of _envs.tf
+  :return: dict of workspace name -> Workspace, in file order
+  """
+  return dict((name, Workspace(name, settings)) for name, settings in load_cached(envs_file, _parse_envs).items())
+
+
+def load_deploy(deploy_file):
+  """
+  :param deploy_file: path of deploy.yaml
+  :return: the parsed deploy.yaml
+  """
+  return load_cached(deploy_file, _parse_yaml)
@@ -0,0 +1,231 @@
+import atexit
+import os
+import re
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from .tfcache import PYRUNNER_DIR
+
+SESSION_NAME = "AssumeRoleSessionCI"
+
+# refresh credentials that expire sooner than this, so a terraform process
+# started with them can still finish a long apply
+REFRESH_MARGIN = timedelta(minutes=15)
+
+# a role that could not be assumed is not asked for again before this many seconds
+FAILURE_RETRY = 60
+
+# credentials files of the provider roles, one per orchestrator process
+CREDENTIALS_DIR = os.path.join(PYRUNNER_DIR, "credentials")
+
+# assume_role blocks of the providers override picking the role from the envs variable
+ASSUME_ROLE_RE = re.compile(r'assume_role\s*\{\s*role_arn\s*=\s*'
+                            r'(lookup\(var\.envs\[(terraform\.workspace|"(\w+)")\],\s*"(\w+)"\))\s*\}')
+
+# credentials of the orchestrator itself that must not leak into the children
+CREDENTIAL_ENV_VARS = ["AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY", "AWS_SESSION_TOKEN", "AWS_SECURITY_TOKEN",
+                       "AWS_PROFILE", "AWS_DEFAULT_PROFILE", "AWS_ROLE_ARN", "AWS_WEB_IDENTITY_TOKEN_FILE"]
+
+
+def _sts_client():
+  import boto3
+
+  return boto3.client('sts')
+
+
+def profile_name(role_arn):
+  """
+  :return: the profile the credentials of a role are written under, the same
+           name profile_override() makes terraform compute
+  """
+  return "pyrunner-" + re.sub(r'[^0-9A-Za-z]+', '-', role_arn)
+
+
+def provider_roles(override_text, workspace, envs):
+  """
+  Roles the providers of an override switch to
+  :param override_text: content of providers_override.tf
+  :param workspace: workspace the module runs in
+  :param envs: dict of workspace -> settings, the envs variable
+  :return: list of role ARNs, None when a role is not a lookup in the envs variable
+  """
+  matches = ASSUME_ROLE_RE.findall(override_text)
+  if len(matches) != override_text.count("assume_role"):
+    return None
+  roles = []
+  for _, _, env_name, setting in matches:
+    role_arn = envs.get(env_name or workspace, {}).get(setting)
+    if not role_arn:
+      return None
+    roles.append(role_arn)
+  return roles
+
+
+def profile_override(override_text):
+  """
+  The providers override using the profiles written by the broker instead
+  of assuming the roles in every terraform process
+  """
+  return ASSUME_ROLE_RE.sub(lambda m: f'profile = "pyrunner-${{replace({m.group(1)}, "/[^0-9A-Za-z]+/", "-")}}"',
+                            override_text)
+
+
+class CredentialBroker:
+  """
+  Assumes every role once per run and shares the temporary credentials
+  between all threads, boto3 clients and terraform child processes.
+  Credentials are refreshed when they get close to expiring.
+  """
+  def __init__(self, sts_client_factory=None, duration_seconds=3600, refresh_margin=REFRESH_MARGIN):
+    """
+    :param sts_client_factory: callable returning the STS client, e.g. one pointed at a local STS stub
+    :param duration_seconds: lifetime of the assumed role credentials
+    :param refresh_margin: timedelta before expiry at which credentials are refreshed
+    """
+    self.sts_client_factory = sts_client_factory or _sts_client
+    self.duration_seconds = duration_seconds
+    self.refresh_margin = refresh_margin
+    self.lock = threading.Lock()
+    self.role_locks = {}
+    self.credentials = {}
+    self.failures = {}
+    self.clients = {}
+    self.profiles = {}
+    self.sts = None
+    self.assume_count = 0
+
+  def _role_lock(self, role_arn):
+    with self.lock:
+      return self.role_locks.setdefault(role_arn, threading.Lock())
+
+  def _fresh(self, credentials):
+    expiration = credentials['Expiration']
+    if expiration.tzinfo is None:
+      expiration = expiration.replace(tzinfo=timezone.utc)
+    return expiration - datetime.now(timezone.utc) > self.refresh_margin
+
+  def _sts(self, source_role):
+    if source_role is not None:
+      return self.client('sts', None, source_role)
+    with self.lock:
+      if self.sts is None:
+        self.sts = self.sts_client_factory()
+      return self.sts
+
+  def get(self, role_arn, source_role=None):
+    """
+    Temporary credentials of a role, assumed at most once until they are about to expire
+    :param role_arn: the role to assume
+    :param source_role: role whose credentials assume it, None for the orchestrator's own
+    :return: the STS Credentials dict (AccessKeyId, SecretAccessKey, SessionToken, Expiration)
+    """
+    key = (role_arn, source_role)
+    # one lock per role: threads wanting the same role wait for a single assume_role call
+    with self._role_lock(key):
+      credentials = self.credentials.get(key)
+      if credentials is None or not self._fresh(credentials):
+        failed_at, error = self.failures.get(key, (None, None))
+        if failed_at is not None and time.monotonic() - failed_at < FAILURE_RETRY:
+          raise error
+        try:
+          credentials = self._sts(source_role).assume_role(
+            RoleArn=role_arn,
+            RoleSessionName=SESSION_NAME,
+            DurationSeconds=self.duration_seconds
+          )['Credentials']
+        except Exception as exc:
+          self.failures[key] = (time.monotonic(), exc)
+          raise
+        self.failures.pop(key, None)
+        self.credentials[key] = credentials
+        self.assume_count += 1
+      return credentials
+
+  def env(self, role_arn, base_env=None):
+    """
+    Environment for a child process that runs with the role's credentials
+    :param role_arn: the role, None to keep the orchestrator's own credentials
+    :param base_env: environment to start from, defaults to os.environ
+    :return: environment dict
+    """
+    env = dict(os.environ if base_env is None else base_env)
+    if role_arn is None:
+      return env
+    credentials = self.get(role_arn)
+    for name in CREDENTIAL_ENV_VARS:
+      env.pop(name, None)
+    env["AWS_ACCESS_KEY_ID"] = credentials['AccessKeyId']
+    env["AWS_SECRET_ACCESS_KEY"] = credentials['SecretAccessKey']
+    env["AWS_SESSION_TOKEN"] = credentials['SessionToken']
+    return env
+
+  def profiles_env(self, role_arns, source_role=None, base_env=None):
+    """
+    Environment for a child process whose providers use profiles instead of
+    assuming roles, see profile_override(): the credentials of every role
+    are written under profile_name(role) to a credentials file of this process
+    :param role_arns: roles the providers switch to
+    :param source_role: role assuming them and running the process, None for the orchestrator's own credentials
+    :param base_env: environment to start from, defaults to os.environ
+    :return: environment dict
+    """
+    env = self.env(source_role, base_env)
+    credentials = dict((role_arn, self.get(role_arn, source_role)) for role_arn in role_arns)
+    env["AWS_SHARED_CREDENTIALS_FILE"] = self._write_profiles(credentials)
+    return env
+
+  def _write_profiles(self, credentials):
+    file_path = os.path.abspath(os.path.join(CREDENTIALS_DIR, f"credentials-{os.getpid()}"))
+    with self.lock:
+      if any(self.profiles.get(role_arn) is not c for role_arn, c in credentials.items()):
+        if not self.profiles:
+          atexit.register(_remove, file_path)
+        self.profiles.update(credentials)
+        lines = []
+        for role_arn, c in sorted(self.profiles.items()):
+          lines += [f"[{profile_name(role_arn)}]", f"aws_access_key_id = {c['AccessKeyId']}",
+                    f"aws_secret_access_key = {c['SecretAccessKey']}", f"aws_session_token = {c['SessionToken']}", ""]
+        os.makedirs(CREDENTIALS_DIR, mode=0o700, exist_ok=True)
+        # running terraform processes never read a half written file
+        tmp_path = f"{file_path}.tmp"
+        with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+          f.write("\n".join(lines))
+        os.replace(tmp_path, file_path)
+    return file_path
+
+  def client(self, service, region, role_arn=None, endpoint_url=None, config=None):
+    """
+    A boto3 client running with the role's credentials, shared between
+    threads and re-created only when the credentials were refreshed
+    :param service: AWS service name
+    :param region: AWS region
+    :param role_arn: the role, None for the orchestrator's own credentials
+    :param endpoint_url: endpoint of a local stand-in of the service, None for AWS
+    :param config: botocore Config of the client, e.g. timeouts and retries
+    """
+    import boto3
+
+    credentials = self.get(role_arn) if role_arn else None
+    key = (service, region, role_arn, endpoint_url, config)
+    with self.lock:
+      cached = self.clients.get(key)
+      if cached is None or cached[0] is not credentials:
+        if credentials is None:
+          client = boto3.client(service, region, endpoint_url=endpoint_url, config=config)
+        else:
+          client = boto3.client(service, region, endpoint_url=endpoint_url, config=config,
+                                aws_access_key_id=credentials['AccessKeyId'],
+                                aws_secret_access_key=credentials['SecretAccessKey'],
+                                aws_session_token=credentials['SessionToken'])
+        cached = (credentials, client)
+        self.clients[key] = cached
+      return cached[1]
+
+
+def _remove(file_path):
+  if os.path.exists(file_path):
+    os.remove(file_path)
+
+
+broker = CredentialBroker()
@@ -0,0 +1,163 @@
+import asyncio
+import collections
+import contextvars
+import os
+import re
+import signal
+import sys
+
+from .tfcache import PYRUNNER_DIR
+
+LOGS_DIR = os.path.join(PYRUNNER_DIR, "logs")
+
+# terraform can print very long lines (e.g. json policies in a plan)
+STREAM_LIMIT = 1024 * 1024
+
+# last lines of output kept per module, to tell why a command failed
+LOG_TAIL_LINES = 200
+
+# how long a cancelled terraform process gets to stop before it is killed
+STOP_TIMEOUT = 60
+
+# child processes currently running -> key of the module that started them,
+# so they can be measured and signalled on abort
+running_processes = {}
+
+# terminal colours and styles of the terraform output
+ANSI_RE = re.compile(r'\x1b\[[0-9;]*m')
+
+# extra destinations of the module output, e.g. the clients following a
+# `pyrunner serve` job; tasks inherit it from the job that started them
+log_listeners = contextvars.ContextVar("log_listeners", default=())
+
+
+def strip_colors(line):
+  """
+  :return: the line without its terminal colour codes
+  """
+  return ANSI_RE.sub('', line)
+
+
+def module_key(workspace, module_path):
+  """
+  :return: key identifying a workspace/module run
+  """
+  return f"{workspace}/{module_path.replace('./', '')}"
+
+
+class ModuleLog:
+  """
+  Output of one workspace/module run: every line goes to stdout prefixed
+  with [workspace/module] and, unprefixed and without colours, to the module
+  log file and the tail the failures are told apart with
+  """
+  def __init__(self, workspace, module_path):
+    self.key = module_key(workspace, module_path)
+    self.prefix = f"[{workspace}/{module_path.rstrip('/').split('/')[-1]}] "
+    self.path = os.path.join(LOGS_DIR, workspace, module_path.replace('./', '').strip('/').replace('/', '_') + ".log")
+    os.makedirs(os.path.dirname(self.path), exist_ok=True)
+    self.log_file = open(self.path, 'w')
+    self.listeners = log_listeners.get()
+    self.tail = collections.deque(maxlen=LOG_TAIL_LINES)
+    self.phases = {}
+
+  def write(self, line):
+    line = line.rstrip('\n')
+    sys.stdout.write(self.prefix + line + "\n")
+    sys.stdout.flush()
+    plain = strip_colors(line)
+    self.log_file.write(plain + "\n")
+    self.tail.append(plain)
+    for listener in self.listeners:
+      listener(self.prefix + line)
+
+  def info(self, message):
+    for line in str(message).splitlines() or [""]:
+      self.write(line)
+
+  def close(self):
+    self.log_file.close()
+
+
+async def _pump(stream, log):
+  while True:
+    line = await stream.readline()
+    if not line:
+      break
+    log.write(line.decode(errors='replace'))
+
+
+async def run_command(args, cwd, log, env=None):
+  """
+  Run a command without a shell and stream its stdout/stderr line by line
+  into the module log
+  :param args: command and arguments
+  :param cwd: working directory of the command
+  :param log: ModuleLog of the module
+  :param env: environment of the command, defaults to the orchestrator's one
+  :return: exit code of the command
+  """
+  log.info("$ " + " ".join(args))
+  proc = await asyncio.create_subprocess_exec(*args, cwd=cwd, env=env,
+                                              stdout=asyncio.subprocess.PIPE,
+                                              stderr=asyncio.subprocess.PIPE,
+                                              limit=STREAM_LIMIT)
+  running_processes[proc] = log.key
+  try:
+    await asyncio.gather(_pump(proc.stdout, log), _pump(proc.stderr, log))
+    return await proc.wait()
+  except asyncio.CancelledError:
+    # give terraform the chance to stop gracefully and release its state lock
+    log.info(f"stopping {args[0]} (pid {proc.pid})...")
+    await _stop(proc)
+    raise
+  finally:
+    running_processes.pop(proc, None)
+
+
+async def capture_command(args, cwd, log, env=None):
+  """
+  Run a command without a shell, keep its stdout and stream its stderr into
+  the module log
+  :return: (exit code, stdout text)
+  """
+  log.info("$ " + " ".join(args))
+  proc = await asyncio.create_subprocess_exec(*args, cwd=cwd, env=env,
+                                              stdout=asyncio.subprocess.PIPE,
+                                              stderr=asyncio.subprocess.PIPE,
+                                              limit=STREAM_LIMIT)
+  running_processes[proc] = log.key
+  try:
+    stdout, _ = await asyncio.gather(proc.stdout.read(), _pump(proc.stderr, log))
+    return await proc.wait(), stdout.decode(errors='replace')
+  except asyncio.CancelledError:
+    log.info(f"stopping {args[0]} (pid {proc.pid})...")
+    await _stop(proc)
+    raise
+  finally:
+    running_processes.pop(proc, None)
+
+
+async def _stop(proc):
+  if proc.returncode is not None:
+    return
+  try:
+    proc.send_signal(signal.SIGINT)
+    await asyncio.wait_for(asyncio.shield(proc.wait()), STOP_TIMEOUT)
+  except ProcessLookupError:
+    pass
+  except asyncio.TimeoutError:
+    proc.kill()
+    await proc.wait()
+
+
+def terminate_running():
+  """
+  Ask every running child process to stop (terraform releases its state lock on SIGTERM)
+  """
+  for proc in list(running_processes):
+    if proc.returncode is None:
+      try:
+        proc.terminate()
+      except ProcessLookupError:
+        pass
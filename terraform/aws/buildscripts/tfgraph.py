@@ -0,0 +1,172 @@
+import os
+import re
+
+# data "terraform_remote_state" "<name>" { ... }
+REMOTE_STATE_RE = re.compile(r'data\s+"terraform_remote_state"\s+"([^"]+)"\s*\{')
+
+# key = format("env:/%s/%s/%s", terraform.workspace, "vpc", "terraform.tfstate")
+FORMAT_KEY_RE = re.compile(r'key\s*=\s*format\(\s*"env:/%s/%s/%s"\s*,\s*([^,]+?)\s*,\s*"([^"]+)"\s*,\s*"terraform\.tfstate"\s*\)')
+
+# key = "env:/dev/vpc/terraform.tfstate" or key = "vpc/terraform.tfstate"
+LITERAL_KEY_RE = re.compile(r'key\s*=\s*"(?:env:/([^/"]+)/)?([^/"]+)/terraform\.tfstate"')
+
+# source = "../../../modules/iam/role"
+LOCAL_SOURCE_RE = re.compile(r'^\s*source\s*=\s*"(\.\.?/[^"]+)"', re.MULTILINE)
+
+
+class DependencyCycleError(Exception):
+  """
+  Raised when the remote state references between modules form a cycle
+  """
+  def __init__(self, cycle):
+    self.cycle = cycle
+    super().__init__("dependency cycle: " + " -> ".join(cycle))
+
+
+def module_state_name(module_path):
+  """
+  The name a module's state is stored under, i.e. key=<name>/terraform.tfstate
+  :param module_path: path of the module e.g. ./main/networkings/vpc
+  :return: state name
+  """
+  return module_path.rstrip('/').split('/')[-1].split('.')[0]
+
+
+def _block_body(text, start):
+  """
+  Return the text of a {...} block whose opening brace is at text[start - 1]
+  """
+  depth = 1
+  pos = start
+  while pos < len(text) and depth > 0:
+    if text[pos] == '{':
+      depth += 1
+    elif text[pos] == '}':
+      depth -= 1
+    pos += 1
+  return text[start:pos - 1]
+
+
+def parse_remote_states(module_path):
+  """
+  Scan the .tf files of a module for terraform_remote_state data sources
+  :param module_path: path of the module directory
+  :return: list of (workspace, state name) tuples, workspace is None when the
+           key refers to the current terraform.workspace
+  """
+  refs = []
+  for name in sorted(os.listdir(module_path)):
+    if not name.endswith('.tf'):
+      continue
+    file_path = os.path.join(module_path, name)
+    if os.path.islink(file_path):
+      # skip the linked variables/_*.tf files
+      continue
+    with open(file_path, 'r') as tf_file:
+      text = tf_file.read()
+    for match in REMOTE_STATE_RE.finditer(text):
+      body = _block_body(text, match.end())
+      key = FORMAT_KEY_RE.search(body)
+      if key:
+        workspace = key.group(1).strip()
+        if workspace == "terraform.workspace":
+          workspace = None
+        else:
+          workspace = workspace.strip('"')
+        refs.append((workspace, key.group(2)))
+        continue
+      key = LITERAL_KEY_RE.search(body)
+      if key:
+        refs.append((key.group(1) or "default", key.group(2)))
+  return refs
+
+
+def parse_module_sources(module_path):
+  """
+  Find the local module directories a module calls, following nested local
+  module calls as well
+  :param module_path: path of the module directory
+  :return: sorted list of normalised local module source directories
+  """
+  sources = set()
+  pending = [module_path]
+  while pending:
+    path = pending.pop()
+    for name in sorted(os.listdir(path)):
+      file_path = os.path.join(path, name)
+      if not name.endswith('.tf') or os.path.islink(file_path):
+        continue
+      with open(file_path, 'r') as tf_file:
+        for source in LOCAL_SOURCE_RE.findall(tf_file.read()):
+          source_path = os.path.normpath(os.path.join(path, source))
+          if source_path not in sources and os.path.isdir(source_path):
+            sources.add(source_path)
+            pending.append(source_path)
+  return sorted(sources)
+
+
+def build_dependency_graph(modules, workspace):
+  """
+  Build a DAG over the selected modules from their remote state references
+  :param modules: list of module paths selected to run
+  :param workspace: the workspace the modules are run in
+  :return: (deps, missing) where deps maps each module to the set of modules
+           it must wait for, and missing maps each module to the state names
+           it reads that no selected module produces
+  """
+  producers = {}
+  for module in modules:
+    producers[module_state_name(module)] = module
+
+  deps = {}
+  missing = {}
+  for module in modules:
+    deps[module] = set()
+    for ref_workspace, state_name in parse_remote_states(module):
+      if ref_workspace is not None and ref_workspace != workspace:
+        # state of another workspace, not built by this run
+        continue
+      producer = producers.get(state_name)
+      if producer is None:
+        missing.setdefault(module, []).append(state_name)
+      elif producer != module:
+        deps[module].add(producer)
+  return deps, missing
+
+
+def topological_order(deps):
+  """
+  Order modules so that every module comes after its upstreams
+  :param deps: dict of module -> set of upstream modules
+  :return: list of modules in dependency order (stable w.r.t. input order)
+  """
+  order = []
+  state = {}
+
+  def visit(module, path):
+    if state.get(module) == "done":
+      return
+    if state.get(module) == "visiting":
+      raise DependencyCycleError(path[path.index(module):] + [module])
+    state[module] = "visiting"
+    for upstream in sorted(deps[module]):
+      visit(upstream, path + [module])
+    state[module] = "done"
+    order.append(module)
+
+  for module in deps:
+    visit(module, [])
+  return order
+
+
+def dependents_of(deps):
+  """
+  Invert the dependency graph
+  :param deps: dict of module -> set of upstream modules
+  :return: dict of module -> set of downstream modules
+  """
+  dependents = {module: set() for module in deps}
+  for module, upstreams in deps.items():
+    for upstream in upstreams:
+      dependents[upstream].add(module)
+  return dependents
@@ -0,0 +1,165 @@
+import json
+import os
+import sqlite3
+import statistics
+import time
+
+from .tfcache import RESULTS_DIR
+from .tfresults import NO_CHANGES, SUCCEEDED
+
+# every module run: workspace, module, action, outcome and phase durations
+HISTORY_FILE = os.path.join(RESULTS_DIR, "history.sqlite3")
+
+# runs older than this are dropped
+HISTORY_RETENTION = 90 * 24 * 3600
+
+# recent successful runs a module's expected duration is the median of
+HISTORY_SAMPLES = 5
+
+# estimate for modules that never ran, when no module has a recorded duration either
+DEFAULT_DURATION = 60.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS module_runs (
+  id        INTEGER PRIMARY KEY,
+  started   REAL NOT NULL,
+  workspace TEXT NOT NULL,
+  module    TEXT NOT NULL,
+  action    TEXT NOT NULL,
+  kind      TEXT NOT NULL,
+  status    TEXT NOT NULL,
+  duration  REAL,
+  phases    TEXT
+);
+CREATE INDEX IF NOT EXISTS module_runs_kind ON module_runs (kind, workspace, module, started);
+"""
+
+
+def action_kind(tfaction):
+  # an apply includes its plan, so plans and applies are timed separately
+  return "apply" if tfaction.startswith("apply") else "plan"
+
+
+def _connect():
+  os.makedirs(RESULTS_DIR, exist_ok=True)
+  connection = sqlite3.connect(HISTORY_FILE, timeout=30)
+  connection.executescript(SCHEMA)
+  return connection
+
+
+def record_runs(build_data_list, workspace_results):
+  """
+  Add the modules that ran to the history
+  :param workspace_results: dict of workspace -> dict of module -> ModuleResult
+  """
+  now = time.time()
+  rows = []
+  for build_data in build_data_list:
+    for module_path, result in workspace_results.get(build_data["workspace"], {}).items():
+      if result.duration is None:
+        # never started: blocked, cancelled while queued or not run
+        continue
+      rows.append((now - result.duration, build_data["workspace"], module_path, build_data["tfaction"],
+                   action_kind(build_data["tfaction"]), result.status, result.duration,
+                   json.dumps(getattr(result, "phases", None) or {}, sort_keys=True)))
+  if not rows:
+    return
+
+  connection = _connect()
+  try:
+    with connection:
+      connection.executemany("INSERT INTO module_runs (started, workspace, module, action, kind, status, duration, "
+                             "phases) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+      connection.execute("DELETE FROM module_runs WHERE started < ?", (now - HISTORY_RETENTION,))
+  finally:
+    connection.close()
+
+
+def expected_durations(tfaction):
+  """
+  Expected duration of every module with a history, the median of its latest
+  successful runs for the kind of action
+  :return: dict of (workspace, module) -> seconds
+  """
+  if not os.path.exists(HISTORY_FILE):
+    return {}
+  connection = _connect()
+  try:
+    rows = connection.execute("SELECT workspace, module, duration FROM module_runs "
+                              "WHERE kind = ? AND status IN (?, ?) ORDER BY started DESC",
+                              (action_kind(tfaction), SUCCEEDED, NO_CHANGES)).fetchall()
+  finally:
+    connection.close()
+
+  samples = {}
+  for workspace, module_path, duration in rows:
+    module_samples = samples.setdefault((workspace, module_path), [])
+    if len(module_samples) < HISTORY_SAMPLES:
+      module_samples.append(duration)
+  return dict((key, statistics.median(values)) for key, values in samples.items())
+
+
+def save_durations(tfaction, file_path):
+  """
+  Write the expected durations of the run history to a JSON file, to share
+  one copy between runners that must agree on them, see --durations
+  :return: number of modules written
+  """
+  durations = expected_durations(tfaction)
+  workspaces = {}
+  for (workspace, module_path), duration in sorted(durations.items()):
+    workspaces.setdefault(workspace, {})[module_path] = round(duration, 3)
+  with open(file_path, 'w') as f:
+    json.dump({"kind": action_kind(tfaction), "durations": workspaces}, f, indent=2, sort_keys=True)
+  return len(durations)
+
+
+def load_durations(tfaction, file_path):
+  """
+  Read the expected durations written by save_durations
+  :return: dict of (workspace, module) -> seconds, like expected_durations
+  """
+  with open(file_path, 'r') as f:
+    data = json.load(f)
+  if data.get("kind") != action_kind(tfaction):
+    print(f"WARNING: {file_path} holds {data.get('kind')} durations, estimating a {action_kind(tfaction)} with them")
+  return dict(((workspace, module_path), float(duration))
+              for workspace, modules in data["durations"].items() for module_path, duration in modules.items())
+
+
+def estimate(durations, workspace, module_path):
+  """
+  Expected duration of a module, falling back to the same module in other
+  workspaces, then to the median of every module, then to DEFAULT_DURATION
+  :param durations: from expected_durations
+  """
+  if (workspace, module_path) in durations:
+    return durations[(workspace, module_path)]
+  same_module = [d for (_, m), d in durations.items() if m == module_path]
+  if same_module:
+    return statistics.median(same_module)
+  if durations:
+    return statistics.median(durations.values())
+  return DEFAULT_DURATION
+
+
+def critical_path_priorities(order, deps, durations, workspace):
+  """
+  Expected time from the start of each module to the end of the longest chain
+  of modules waiting on it, running modules with the longest one first keeps
+  the slow chains from setting the wall time
+  :param order: modules in dependency order
+  :param deps: dict of module -> set of modules it must wait for
+  :param durations: from expected_durations
+  :return: dict of module -> seconds
+  """
+  dependents = dict((m, []) for m in order)
+  for module, upstreams in deps.items():
+    for upstream in upstreams:
+      dependents[upstream].append(module)
+
+  priorities = {}
+  for module in reversed(order):
+    downstream = max([priorities[d] for d in dependents[module]] or [0.0])
+    priorities[module] = estimate(durations, workspace, module) + downstream
+  return priorities
@@ -0,0 +1,109 @@
+import contextvars
+import glob
+import itertools
+import json
+import os
+import time
+
+from .tfcache import PYRUNNER_DIR
+from .tfresults import NO_CHANGES, RESUMED, SUCCEEDED, UNCHANGED
+
+# one append-only <run>.jsonl file per run
+JOURNAL_DIR = os.path.join(PYRUNNER_DIR, "journal")
+
+# journals of older runs are removed
+JOURNAL_KEEP = 50
+
+# outcomes a resumed run does not repeat
+COMPLETED_STATUSES = [SUCCEEDED, NO_CHANGES, UNCHANGED, RESUMED]
+
+# journal of the run the current task belongs to, set per run like tfexec.log_listeners
+run_journal = contextvars.ContextVar("run_journal", default=None)
+
+# runs started by this process, `pyrunner serve` starts many in the same second
+_run_numbers = itertools.count(1)
+
+
+class Journal:
+  """
+  Checkpoint journal of a run: the action and modules of every workspace,
+  then one line per module phase completed and per module finished, flushed
+  as they happen so a crashed or failed run can be resumed with --resume
+  """
+  def __init__(self, build_data_list):
+    """
+    :param build_data_list: one build_data per workspace
+    """
+    self.run_id = time.strftime("%Y%m%d-%H%M%S") + f"-{os.getpid()}-{next(_run_numbers)}"
+    self.path = os.path.join(JOURNAL_DIR, f"{self.run_id}.jsonl")
+    os.makedirs(JOURNAL_DIR, exist_ok=True)
+    # never append to the journal of another run
+    self.journal_file = open(self.path, 'x')
+    self.write("run", action=build_data_list[0]["tfaction"],
+               workspaces=dict((bd["workspace"], bd["modules"]) for bd in build_data_list))
+    _prune()
+
+  def write(self, event, **fields):
+    self.journal_file.write(json.dumps(dict(event=event, time=time.time(), **fields), sort_keys=True) + "\n")
+    self.journal_file.flush()
+
+  def phase(self, workspace, module_path, phase):
+    """
+    Record a phase of a module (init, plan or apply) that completed
+    """
+    self.write("phase", workspace=workspace, module=module_path, phase=phase)
+
+  def module(self, result, source_hash):
+    """
+    Record the outcome of a module
+    :param result: ModuleResult
+    :param source_hash: hash of the module inputs it ran with, see tfrun.source_hash
+    """
+    self.write("module", workspace=result.workspace, module=result.module_path, status=result.status,
+               source_hash=source_hash)
+
+  def close(self):
+    self.write("end")
+    self.journal_file.close()
+
+
+def _journals():
+  return sorted(glob.glob(os.path.join(JOURNAL_DIR, "*.jsonl")), key=os.path.getmtime)
+
+
+def _prune():
+  for journal_path in _journals()[:-JOURNAL_KEEP]:
+    os.remove(journal_path)
+
+
+def _read(journal_path):
+  entries = []
+  with open(journal_path, 'r') as f:
+    for line in f:
+      try:
+        entries.append(json.loads(line))
+      except ValueError:
+        # last line of a run killed while writing it
+        break
+  return entries
+
+
+def completed_modules(tfaction):
+  """
+  Modules the latest run of the action completed
+  :return: (run id or None, dict of workspace -> dict of module -> source hash)
+  """
+  for journal_path in reversed(_journals()):
+    entries = _read(journal_path)
+    if not entries or entries[0].get("event") != "run" or entries[0].get("action") != tfaction:
+      continue
+    completed = {}
+    for entry in entries:
+      if entry["event"] == "module":
+        workspace_completed = completed.setdefault(entry["workspace"], {})
+        if entry["status"] in COMPLETED_STATUSES:
+          workspace_completed[entry["module"]] = entry["source_hash"]
+        else:
+          workspace_completed.pop(entry["module"], None)
+    return os.path.basename(journal_path)[:-len(".jsonl")], completed
+  return None, {}
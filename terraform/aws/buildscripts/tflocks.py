@@ -0,0 +1,66 @@
+import asyncio
+import os
+import random
+import weakref
+
+# terraform prints this when another process holds the DynamoDB state lock
+STATE_LOCK_ERROR = "Error acquiring the state lock"
+
+# how long terraform itself waits for a held state lock
+DEFAULT_LOCK_TIMEOUT = "60s"
+DEFAULT_LOCK_RETRIES = 3
+
+LOCK_BACKOFF_BASE = 15
+LOCK_BACKOFF_MAX  = 240
+
+# point the backend and the state reads at a local S3/DynamoDB stand-in (e.g. moto or localstack)
+S3_ENDPOINT_ENV       = "PYRUNNER_S3_ENDPOINT"
+DYNAMODB_ENDPOINT_ENV = "PYRUNNER_DYNAMODB_ENDPOINT"
+
+# event loop -> dict of (bucket, state object key) -> asyncio.Lock
+_state_locks = weakref.WeakKeyDictionary()
+
+
+def state_lock(bucket, state_key):
+  """
+  Lock serialising the runs of this process that target the same state
+  :param bucket: state bucket
+  :param state_key: state object key, see tfstate.state_object_key
+  :return: asyncio.Lock
+  """
+  locks = _state_locks.setdefault(asyncio.get_event_loop(), {})
+  if (bucket, state_key) not in locks:
+    locks[(bucket, state_key)] = asyncio.Lock()
+  return locks[(bucket, state_key)]
+
+
+def lock_contended(lines):
+  """
+  :param lines: output of a failed terraform command
+  :return: True when it failed because the state lock is held elsewhere
+  """
+  return any(STATE_LOCK_ERROR in line for line in lines)
+
+
+def lock_backoff(attempt):
+  """
+  Seconds to wait before retry `attempt` (0 based), exponential with jitter
+  """
+  return min(LOCK_BACKOFF_MAX, LOCK_BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+
+def s3_endpoint():
+  return os.getenv(S3_ENDPOINT_ENV) or None
+
+
+def backend_endpoint_config():
+  """
+  Extra -backend-config settings when a local S3/DynamoDB stand-in is configured
+  :return: list of key=value settings
+  """
+  config = []
+  if s3_endpoint():
+    config += [f"endpoint={s3_endpoint()}", "force_path_style=true", "skip_credentials_validation=true"]
+  if os.getenv(DYNAMODB_ENDPOINT_ENV):
+    config.append(f"dynamodb_endpoint={os.getenv(DYNAMODB_ENDPOINT_ENV)}")
+  return config
@@ -1,36 +1,137 @@
+import json
 import os
-import fnmatch
-
-try:
-  from os import scandir, walk
-except ImportError:
-  from scandir import scandir, walk
 
+from .tfcache import RESULTS_DIR
+from .tfgraph import module_state_name, parse_module_sources, parse_remote_states
 from .tfprompts import *
 
+MODULE_INDEX_FILE = os.path.join(RESULTS_DIR, "module-index.json")
+MODULE_INDEX_VERSION = 1
+
+# never descended into while looking for modules
+PRUNE_DIRS = {".terraform", "initial", ".git"}
+
+
+def _load_index():
+  try:
+    with open(MODULE_INDEX_FILE, 'r') as f:
+      index = json.load(f)
+    if index.get("version") == MODULE_INDEX_VERSION:
+      return index
+  except (OSError, ValueError):
+    pass
+  return {"version": MODULE_INDEX_VERSION, "dirs": {}, "modules": {}}
+
+
+def _save_index(index):
+  os.makedirs(RESULTS_DIR, exist_ok=True)
+  tmp_file = f"{MODULE_INDEX_FILE}.{os.getpid()}.tmp"
+  with open(tmp_file, 'w') as f:
+    json.dump(index, f, separators=(',', ':'), sort_keys=True)
+  os.replace(tmp_file, MODULE_INDEX_FILE)
+
+
+def _mtime_ns(path):
+  try:
+    return os.stat(path).st_mtime_ns
+  except OSError:
+    return None
+
+
+def _scan_tree(root, old_dirs, new_dirs):
+  """
+  Walk a tree with scandir, pruning PRUNE_DIRS. A directory whose mtime is
+  unchanged since the last scan is not listed again, its recorded
+  sub-directories are used instead
+  :return: list of directories containing a main.tf
+  """
+  modules = []
+  pending = [root]
+  while pending:
+    path = pending.pop()
+    mtime_ns = _mtime_ns(path)
+    if mtime_ns is None:
+      continue
+    cached = old_dirs.get(path)
+    if cached is not None and cached["mtime_ns"] == mtime_ns:
+      subdirs, is_module = cached["subdirs"], cached["module"]
+    else:
+      subdirs, is_module = [], False
+      with os.scandir(path) as entries:
+        for entry in entries:
+          if entry.is_dir(follow_symlinks=False):
+            if entry.name not in PRUNE_DIRS:
+              subdirs.append(entry.name)
+          elif entry.name == "main.tf":
+            is_module = True
+      subdirs.sort()
+    new_dirs[path] = {"mtime_ns": mtime_ns, "subdirs": subdirs, "module": is_module}
+    if is_module:
+      modules.append(path)
+    pending.extend(os.path.join(path, d) for d in reversed(subdirs))
+  return modules
+
 
-def find(pattern, path):
-  result = []
-  for root, dirs, files in os.walk(path):
-    for name in files:
-      if fnmatch.fnmatch(name, pattern):
-        if "/initial/" not in os.path.join(root) and ".terraform" not in os.path.join(root):
-          result.append(os.path.join(root))
-  return result
+def _module_inputs(module_path, sources):
+  """
+  Files and directories the module metadata is parsed from, with their mtimes
+  """
+  inputs = {}
+  for path in [module_path] + sources:
+    inputs[path] = _mtime_ns(path)
+    with os.scandir(path) as entries:
+      for entry in entries:
+        if entry.name.endswith('.tf') and not entry.is_symlink():
+          inputs[entry.path] = entry.stat().st_mtime_ns
+  return inputs
+
+
+def _module_metadata(module_path, cached):
+  """
+  Metadata of a module, re-parsed only when one of its inputs changed
+  """
+  if cached is not None and all(_mtime_ns(p) == m for p, m in cached["inputs"].items()):
+    return cached
+  sources = parse_module_sources(module_path)
+  inputs = _module_inputs(module_path, sources)
+  own_files = [m for p, m in inputs.items() if os.path.dirname(p) == module_path and p.endswith('.tf')]
+  return {
+    "remote_states": [list(ref) for ref in parse_remote_states(module_path)],
+    "sources": sources,
+    "backend_key": f"{module_state_name(module_path)}/terraform.tfstate",
+    "mtime": max(own_files) / 1e9 if own_files else None,
+    "inputs": inputs
+  }
+
+
+def module_index(dir_names):
+  """
+  Discover the modules under the given directories and their metadata. The
+  result is kept in MODULE_INDEX_FILE and updated incrementally
+  :param dir_names: directories containing the terraform modules, e.g. ["main"]
+  :return: dict of module path (./main/x/y) -> metadata with remote_states
+           [(workspace, state name)], sources, backend_key and mtime
+  """
+  index = _load_index()
+  new_dirs = {}
+  modules = {}
+  for dir_name in dir_names:
+    for module_path in _scan_tree('./' + dir_name, index["dirs"], new_dirs):
+      modules[module_path] = _module_metadata(module_path, index["modules"].get(module_path))
+
+  new_index = {"version": MODULE_INDEX_VERSION, "dirs": new_dirs, "modules": modules}
+  if new_index != index:
+    _save_index(new_index)
+  return modules
 
 
 def find_modules(dir_names):
   """
   Fetch list of directories (modules) currently supported
-  :param dir_names: The name of directory contains all terraform modules
+  :param dir_names: The names of the directories containing all terraform modules
   :return: list of directory modules
   """
-
-  modules_to_build = []
-  for dir in dir_names:
-    modules_to_build = find('main.tf', './' + dir)
-
-  return modules_to_build
+  return sorted(module_index(dir_names))
 
 
 def prompt_modules(iterable_data):
@@ -0,0 +1,102 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+
+from .tfcache import PYRUNNER_DIR
+
+# terraform plan -detailed-exitcode: 0 no changes, 1 error, 2 changes present
+PLAN_NO_CHANGES = 0
+PLAN_CHANGES    = 2
+
+# saved plans, see --plan-store
+PLAN_STORE_DIR = os.path.join(PYRUNNER_DIR, "plans")
+
+
+def plan_changes(plan_json):
+  """
+  Count the resource changes of a saved plan the way terraform reports them,
+  a replacement counts as one add and one destroy
+  :param plan_json: output of `terraform show -json plan.out`
+  :return: dict with the add, change and destroy counts
+  """
+  changes = {"add": 0, "change": 0, "destroy": 0}
+  for resource_change in json.loads(plan_json).get("resource_changes") or []:
+    actions = resource_change.get("change", {}).get("actions", [])
+    if "create" in actions:
+      changes["add"] += 1
+    if "delete" in actions:
+      changes["destroy"] += 1
+    if actions == ["update"]:
+      changes["change"] += 1
+  return changes
+
+
+def format_changes(changes):
+  """
+  :return: "+add ~change -destroy", or "-" when the changes are unknown
+  """
+  if changes is None:
+    return "-"
+  return f"+{changes['add']} ~{changes['change']} -{changes['destroy']}"
+
+
+class StalePlanError(Exception):
+  """
+  Raised when there is no saved plan for the current inputs and state of a module
+  """
+
+
+def _plan_dir(store, workspace, mod_path):
+  return os.path.join(store, workspace, mod_path.replace('./', '').strip('/').replace('/', '_'))
+
+
+def _plan_name(input_hash, state_serial):
+  # the lineage:serial of a state may contain characters not allowed in file names
+  return f"{input_hash}-{hashlib.sha256(state_serial.encode()).hexdigest()[:16]}"
+
+
+def save_plan(store, workspace, mod_path, input_hash, state_serial, plan_file, destroy, has_changes, changes):
+  """
+  Keep a saved plan in the plan store, keyed by workspace, module, input hash
+  and state serial; older plans of the module are removed
+  :return: path of the stored plan
+  """
+  plan_dir = _plan_dir(store, workspace, mod_path)
+  os.makedirs(plan_dir, exist_ok=True)
+  name = _plan_name(input_hash, state_serial)
+  stored_plan = os.path.join(plan_dir, name + ".plan")
+  shutil.copyfile(plan_file, stored_plan + ".tmp")
+  os.replace(stored_plan + ".tmp", stored_plan)
+  with open(os.path.join(plan_dir, name + ".json.tmp"), 'w') as f:
+    json.dump({"workspace": workspace, "module": mod_path, "input_hash": input_hash, "state_serial": state_serial,
+               "destroy": destroy, "has_changes": has_changes, "changes": changes, "created": time.time()}, f, indent=2, sort_keys=True)
+  os.replace(os.path.join(plan_dir, name + ".json.tmp"), os.path.join(plan_dir, name + ".json"))
+
+  for entry in os.listdir(plan_dir):
+    if not entry.startswith(name + "."):
+      os.remove(os.path.join(plan_dir, entry))
+  return stored_plan
+
+
+def find_plan(store, workspace, mod_path, input_hash, state_serial, destroy):
+  """
+  The saved plan of a module matching its current inputs and state
+  :return: (path of the saved plan, plan metadata)
+  :raise StalePlanError: when there is no saved plan, or it was made for other inputs or another state
+  """
+  plan_dir = _plan_dir(store, workspace, mod_path)
+  if not os.path.isdir(plan_dir) or not os.listdir(plan_dir):
+    raise StalePlanError(f"no saved plan in {plan_dir}")
+  if input_hash is None or state_serial is None:
+    raise StalePlanError("unable to read the module inputs or state to check the saved plan")
+  name = _plan_name(input_hash, state_serial)
+  try:
+    with open(os.path.join(plan_dir, name + ".json"), 'r') as f:
+      metadata = json.load(f)
+  except (OSError, ValueError):
+    raise StalePlanError("saved plan is stale, the module inputs or its state changed since it was planned")
+  if metadata["destroy"] != destroy:
+    raise StalePlanError(f"saved plan is a {'destroy' if metadata['destroy'] else 'apply'} plan")
+  return os.path.join(plan_dir, name + ".plan"), metadata
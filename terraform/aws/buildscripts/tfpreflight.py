@@ -0,0 +1,169 @@
+import asyncio
+import os
+import platform
+import re
+import shutil
+
+from .tfcache import backend_fingerprint, read_fingerprint, setup_plugin_cache, write_fingerprint, LOCK_FILE, PYRUNNER_DIR
+from .tfexec import ModuleLog, run_command
+from .tfresources import default_max_workers
+from .tfresults import ModuleResult, FAILED
+from .tfstage import stage_module
+
+# staging directories of the pre-flight checks, apart from the ones of the runs
+PREFLIGHT_DIR = os.path.join(PYRUNNER_DIR, "preflight")
+
+PROVIDERS_OVERRIDE = os.path.join("variables", "config", "providers_override.tf")
+
+# output lines of a failed check kept in the report
+REPORT_LINES = 20
+
+# provider "registry.terraform.io/hashicorp/aws" { version = "5.1.0" ... } blocks of a lock file
+LOCKED_PROVIDER_RE = re.compile(r'^provider\s+"([^"]+)"\s*\{\s*version\s*=\s*"([^"]+)"', re.MULTILINE)
+
+# terraform's names of the machine architectures
+ARCHITECTURES = {"x86_64": "amd64", "aarch64": "arm64", "i686": "386", "i386": "386"}
+
+
+class PreflightFailure:
+  """
+  A module that failed one of the pre-flight checks
+  """
+  def __init__(self, module_path, check, exit_code, lines):
+    self.module_path = module_path
+    self.check = check
+    self.exit_code = exit_code
+    self.lines = lines
+
+
+def providers_cached(work_dir, cache_dir):
+  """
+  :param work_dir: staged module directory
+  :param cache_dir: provider plugin cache
+  :return: True when the cache holds every provider version the module's lock
+           file selects, for this platform; False without a lock file
+  """
+  lock_file = os.path.join(work_dir, LOCK_FILE)
+  if not os.path.exists(lock_file):
+    return False
+  with open(lock_file, 'r') as f:
+    providers = LOCKED_PROVIDER_RE.findall(f.read())
+  machine = platform.machine().lower()
+  target = f"{platform.system().lower()}_{ARCHITECTURES.get(machine, machine)}"
+  return bool(providers) and all(os.path.isdir(os.path.join(cache_dir, source, version, target))
+                                 for source, version in providers)
+
+
+async def _init(work_dir, init_args, cache_dir, log):
+  """
+  terraform init offline from the plugin cache when it holds every provider
+  the module needs, otherwise, or when that fails, a regular init through
+  TF_PLUGIN_CACHE_DIR that downloads the missing ones into the cache
+  :return: exit code
+  """
+  if providers_cached(work_dir, cache_dir):
+    status = await run_command(["terraform"] + init_args + [f"-plugin-dir={cache_dir}"], work_dir, log)
+    if status == 0:
+      return status
+    log.info("Init from the plugin cache failed, initialising from the provider registries")
+    log.tail.clear()
+  return await run_command(["terraform"] + init_args, work_dir, log)
+
+
+def _link_variables(work_dir, link_files):
+  for name in link_files:
+    link_path = os.path.join(work_dir, name)
+    if not os.path.lexists(link_path):
+      os.symlink(os.path.abspath(os.path.join("variables", name)), link_path)
+  shutil.copy(PROVIDERS_OVERRIDE, work_dir)
+
+
+async def check_module(module_path, link_files, cache_dir, semaphore):
+  """
+  terraform fmt -check, init -backend=false and validate of one module in its
+  pre-flight staging directory, without touching the backend
+  :param link_files: variables files the module is run with
+  :param cache_dir: provider plugin cache, see _init
+  :return: PreflightFailure or None
+  """
+  async with semaphore:
+    mod_path = os.path.normpath(module_path)
+    log = ModuleLog("preflight", module_path)
+    try:
+      work_dir = stage_module(None, mod_path, link_files, PREFLIGHT_DIR)
+      _link_variables(work_dir, link_files)
+
+      # where the providers come from does not change the result of init
+      init_args = ["init", "-backend=false", "-input=false"]
+      fingerprint = backend_fingerprint(mod_path, init_args, [PROVIDERS_OVERRIDE])
+      checks = [("fmt", ["fmt", "-check", "-list=true"]), ("validate", ["validate"])]
+      if read_fingerprint(work_dir) != fingerprint:
+        checks.insert(1, ("init", init_args))
+
+      for check, args in checks:
+        log.tail.clear()
+        if check == "init":
+          status = await _init(work_dir, args, cache_dir, log)
+        else:
+          status = await run_command(["terraform"] + args, work_dir, log)
+        if status != 0:
+          # the command line itself is the first line of the tail
+          return PreflightFailure(module_path, check, status, list(log.tail)[1:][-REPORT_LINES:])
+        if check == "init":
+          write_fingerprint(work_dir, fingerprint)
+      return None
+    except OSError as exc:
+      return PreflightFailure(module_path, "stage", None, [str(exc)])
+    finally:
+      log.close()
+
+
+async def run_preflight(build_data_list, link_files):
+  """
+  Check every module of the run, once whatever the number of workspaces, all
+  at the same time
+  :param build_data_list: one build_data per workspace
+  :param link_files: variables files linked into every module
+  :return: list of PreflightFailure, empty when every module passed
+  """
+  modules = []
+  for build_data in build_data_list:
+    modules += [m for m in build_data["modules"] if m not in modules]
+
+  # providers already in the plugin cache make init work offline
+  cache_dir = setup_plugin_cache()
+  if not os.listdir(cache_dir):
+    print(f"Provider plugin cache {cache_dir} is empty, pre-flight init downloads the providers once")
+
+  semaphore = asyncio.Semaphore(build_data_list[0].get("max_workers") or default_max_workers())
+  failures = await asyncio.gather(*[check_module(m, link_files, cache_dir, semaphore) for m in modules])
+  return [f for f in failures if f is not None]
+
+
+def preflight_report(failures):
+  """
+  :return: report of every failed module, to print before aborting the run
+  """
+  lines = [f"\n******* Pre-flight failed for {len(failures)} module(s) *********"]
+  for failure in failures:
+    exit_code = "" if failure.exit_code is None else f" (exit code {failure.exit_code})"
+    lines.append(f"{failure.module_path}: terraform {failure.check} failed{exit_code}")
+    lines += ["    " + line for line in failure.lines]
+  lines.append("**********************************")
+  return "\n".join(lines)
+
+
+def preflight_results(build_data_list, failures):
+  """
+  Results of a run aborted by the pre-flight checks: the failed modules
+  fail in every workspace, the others are not run
+  :return: dict of workspace -> dict of module -> ModuleResult
+  """
+  failed = dict((f.module_path, f) for f in failures)
+  workspace_results = {}
+  for build_data in build_data_list:
+    workspace = build_data["workspace"]
+    workspace_results[workspace] = dict(
+      (m, ModuleResult(workspace, m, FAILED, f"preflight-{failed[m].check}", failed[m].exit_code))
+      for m in build_data["modules"] if m in failed)
+  return workspace_results
@@ -1,4 +1,4 @@
-from iterfzf import iterfzf
+from .tfregions import Regions
 
 def fetch_regions():
   """
@@ -21,6 +21,8 @@ def prompt_user(iterable_data, **prompt_options):
   :param prompt_options:
   :return: The user selected data
   """
+  from iterfzf import iterfzf
+
   return iterfzf(iterable_data, **prompt_options)
 
 
@@ -1,5 +1,11 @@
-import boto3
+import concurrent.futures
+import functools
+import json
 import os
+import time
+
+from .tfcache import RESULTS_DIR
+from .tfcredentials import broker
 
 REGION = "eu-west-2"
 
@@ -8,17 +14,100 @@ if os.getenv("REGION", None) is None:
 else:
   REGION = os.getenv('REGION')
 
-ssm = boto3.client('ssm', REGION)
+REGIONS_PATH = '/aws/service/global-infrastructure/regions'
+
+# ssm.get_parameters accepts at most 10 names per call
+GET_PARAMETERS_BATCH = 10
+
+REGIONS_CACHE_FILE = os.path.join(RESULTS_DIR, "regions.json")
+REGIONS_CACHE_TTL  = 7 * 24 * 3600
+
+# list used after SSM could not be reached, SSM is not tried again before it expires
+REGIONS_FALLBACK_FILE = os.path.join(RESULTS_DIR, "regions-fallback.json")
+REGIONS_FALLBACK_TTL  = 15 * 60
+
+# fail fast when offline instead of going through botocore's default retries
+SSM_CONNECT_TIMEOUT = 2
+SSM_READ_TIMEOUT    = 5
+SSM_MAX_ATTEMPTS    = 2
+
+# used when the region catalogue can be neither fetched nor read from the cache
+FALLBACK_REGIONS = {
+  "af-south-1":     "Africa (Cape Town)",
+  "ap-east-1":      "Asia Pacific (Hong Kong)",
+  "ap-northeast-1": "Asia Pacific (Tokyo)",
+  "ap-northeast-2": "Asia Pacific (Seoul)",
+  "ap-northeast-3": "Asia Pacific (Osaka)",
+  "ap-south-1":     "Asia Pacific (Mumbai)",
+  "ap-south-2":     "Asia Pacific (Hyderabad)",
+  "ap-southeast-1": "Asia Pacific (Singapore)",
+  "ap-southeast-2": "Asia Pacific (Sydney)",
+  "ap-southeast-3": "Asia Pacific (Jakarta)",
+  "ap-southeast-4": "Asia Pacific (Melbourne)",
+  "ca-central-1":   "Canada (Central)",
+  "cn-north-1":     "China (Beijing)",
+  "cn-northwest-1": "China (Ningxia)",
+  "eu-central-1":   "Europe (Frankfurt)",
+  "eu-central-2":   "Europe (Zurich)",
+  "eu-north-1":     "Europe (Stockholm)",
+  "eu-south-1":     "Europe (Milan)",
+  "eu-south-2":     "Europe (Spain)",
+  "eu-west-1":      "Europe (Ireland)",
+  "eu-west-2":      "Europe (London)",
+  "eu-west-3":      "Europe (Paris)",
+  "il-central-1":   "Israel (Tel Aviv)",
+  "me-central-1":   "Middle East (UAE)",
+  "me-south-1":     "Middle East (Bahrain)",
+  "sa-east-1":      "South America (Sao Paulo)",
+  "us-east-1":      "US East (N. Virginia)",
+  "us-east-2":      "US East (Ohio)",
+  "us-gov-east-1":  "AWS GovCloud (US-East)",
+  "us-gov-west-1":  "AWS GovCloud (US-West)",
+  "us-west-1":      "US West (N. California)",
+  "us-west-2":      "US West (Oregon)"
+}
+
+
+@functools.lru_cache(maxsize=None)
+def _ssm_config():
+  from botocore.config import Config
+
+  return Config(connect_timeout=SSM_CONNECT_TIMEOUT, read_timeout=SSM_READ_TIMEOUT,
+                retries={"max_attempts": SSM_MAX_ATTEMPTS, "mode": "standard"})
+
+
+def _ssm():
+  """
+  SSM client of the region, created on first use and shared between threads
+  """
+  return broker.client('ssm', REGION, config=_ssm_config())
+
 
 class Regions:
   @classmethod
   def get_regions(cls):
-    short_codes = cls._get_region_short_codes()
+    """
+    List every region as {'name': long name, 'code': short code}, sorted by name.
+    The catalogue is cached on disk, refreshed from SSM once the cache expired
+    and falls back to a bundled list when SSM can't be reached. The fallback
+    is cached for REGIONS_FALLBACK_TTL so offline runs don't wait on SSM again.
+    """
+    from botocore.exceptions import BotoCoreError, ClientError
+
+    long_names = cls._load_cache(REGIONS_CACHE_TTL) or cls._load_cache(REGIONS_FALLBACK_TTL, REGIONS_FALLBACK_FILE)
+    if long_names is None:
+      try:
+        long_names = cls._get_region_long_names(cls._get_region_short_codes())
+        cls._save_cache(long_names)
+      except (BotoCoreError, ClientError) as error:
+        print(f"Unable to fetch the region list, using the cached/bundled one: {error}")
+        long_names = cls._load_cache(None) or FALLBACK_REGIONS
+        cls._save_cache(long_names, REGIONS_FALLBACK_FILE)
 
     regions = [{
-      'name': cls._get_region_long_name(sc),
+      'name': name,
       'code': sc
-    } for sc in short_codes]
+    } for sc, name in long_names.items()]
 
     regions_sorted = sorted(
       regions,
@@ -28,22 +117,59 @@ class Regions:
     return regions_sorted
 
   @classmethod
-  def _get_region_long_name(cls, short_code):
-    param_name = (
-      '/aws/service/global-infrastructure/regions/'
-      f'{short_code}/longName'
-    )
-    response = ssm.get_parameters(
-      Names=[param_name]
+  def _get_region_long_names(cls, short_codes):
+    """
+    Fetch the long names with one get_parameters call per 10 regions, all batches at once
+    :return: dict of short code -> long name
+    """
+    short_codes = sorted(short_codes)
+    batches = [short_codes[i:i + GET_PARAMETERS_BATCH] for i in range(0, len(short_codes), GET_PARAMETERS_BATCH)]
+    long_names = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(batches))) as executor:
+      for batch_names in executor.map(cls._get_region_long_name_batch, batches):
+        long_names.update(batch_names)
+    return long_names
+
+  @classmethod
+  def _get_region_long_name_batch(cls, short_codes):
+    param_names = dict((f'{REGIONS_PATH}/{sc}/longName', sc) for sc in short_codes)
+    response = _ssm().get_parameters(
+      Names=list(param_names)
     )
-    return response['Parameters'][0]['Value']
+    long_names = dict((sc, sc) for sc in short_codes)
+    for param in response['Parameters']:
+      long_names[param_names[param['Name']]] = param['Value']
+    return long_names
 
   @classmethod
   def _get_region_short_codes(cls):
     output = set()
-    for page in ssm.get_paginator('get_parameters_by_path').paginate(
-        Path='/aws/service/global-infrastructure/regions'
+    for page in _ssm().get_paginator('get_parameters_by_path').paginate(
+        Path=REGIONS_PATH
     ):
       output.update(p['Value'] for p in page['Parameters'])
 
-    return output
\ No newline at end of file
+    return output
+
+  @classmethod
+  def _load_cache(cls, ttl, cache_file=REGIONS_CACHE_FILE):
+    """
+    :param ttl: maximum age of the cache in seconds, None to accept any age
+    :param cache_file: REGIONS_CACHE_FILE or REGIONS_FALLBACK_FILE
+    :return: dict of short code -> long name or None
+    """
+    if not os.path.exists(cache_file):
+      return None
+    if ttl is not None and time.time() - os.path.getmtime(cache_file) > ttl:
+      return None
+    try:
+      with open(cache_file, 'r') as f:
+        return json.load(f) or None
+    except ValueError:
+      return None
+
+  @classmethod
+  def _save_cache(cls, long_names, cache_file=REGIONS_CACHE_FILE):
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    with open(cache_file, 'w') as f:
+      json.dump(long_names, f, indent=2, sort_keys=True)
@@ -0,0 +1,287 @@
+import asyncio
+import heapq
+import itertools
+import os
+import re
+
+from .tfexec import running_processes
+
+MB = 1024 * 1024
+
+# terraform plus the aws provider plugin of one module, until we measured one
+DEFAULT_MODULE_RSS = 400 * MB
+
+# share of the memory limit the terraform children may use
+MEMORY_BUDGET_RATIO = 0.8
+
+# terraform mostly waits on the AWS APIs, allow a couple of modules per core
+WORKERS_PER_CPU = 2
+
+SAMPLE_INTERVAL = 1.0
+
+# /proc/<pid>/task/<tid>/children needs CONFIG_PROC_CHILDREN
+PROC_CHILDREN = os.path.exists(f"/proc/self/task/{os.getpid()}/children")
+
+SIZE_RE = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*([kmgt]?)i?b?\s*$', re.IGNORECASE)
+
+
+def parse_size(size):
+  """
+  Parse a memory size such as 4G, 512M or 1073741824
+  :param size: size string
+  :return: number of bytes
+  """
+  match = SIZE_RE.match(str(size))
+  if match is None:
+    raise ValueError(f"Invalid memory size: {size}")
+  return int(float(match.group(1)) * 1024 ** " kmgt".index(match.group(2).lower() or " "))
+
+
+def _read(file_path):
+  try:
+    with open(file_path, 'r') as f:
+      return f.read().strip()
+  except OSError:
+    return None
+
+
+def cpu_count():
+  """
+  Cores available to this process, honouring affinity and cgroup cpu quotas
+  """
+  try:
+    cpus = len(os.sched_getaffinity(0))
+  except AttributeError:
+    cpus = os.cpu_count() or 1
+
+  quota = None
+  cpu_max = _read("/sys/fs/cgroup/cpu.max")
+  if cpu_max is not None:
+    limit, period = cpu_max.split()
+    if limit != "max":
+      quota = int(limit) / int(period)
+  else:
+    limit = _read("/sys/fs/cgroup/cpu/cpu.cfs_quota_us")
+    period = _read("/sys/fs/cgroup/cpu/cpu.cfs_period_us")
+    if limit is not None and period is not None and int(limit) > 0:
+      quota = int(limit) / int(period)
+
+  if quota is not None:
+    cpus = min(cpus, max(1, int(quota)))
+  return cpus
+
+
+def _meminfo(field):
+  meminfo = _read("/proc/meminfo")
+  if meminfo is None:
+    return None
+  match = re.search(rf'^{field}:\s+(\d+) kB', meminfo, re.MULTILINE)
+  return int(match.group(1)) * 1024 if match else None
+
+
+def memory_limit():
+  """
+  Memory this process may use: the cgroup limit if there is one, else the
+  total memory of the machine
+  :return: number of bytes or None when unknown
+  """
+  total = _meminfo("MemTotal")
+  limit = _read("/sys/fs/cgroup/memory.max")
+  if limit is None:
+    limit = _read("/sys/fs/cgroup/memory/memory.limit_in_bytes")
+  if limit is not None and limit != "max" and (total is None or int(limit) < total):
+    return int(limit)
+  return total
+
+
+def process_children():
+  """
+  :return: dict of pid -> list of child pids of every running process
+  """
+  children = {}
+  try:
+    pids = [int(p) for p in os.listdir("/proc") if p.isdigit()]
+  except OSError:
+    return children
+  for p in pids:
+    stat = _read(f"/proc/{p}/stat")
+    if stat is not None:
+      # the command name may contain spaces, the ppid is the 2nd field after it
+      children.setdefault(int(stat.rsplit(')', 1)[1].split()[1]), []).append(p)
+  return children
+
+
+def _task_children(pid):
+  pids = []
+  try:
+    tids = os.listdir(f"/proc/{pid}/task")
+  except OSError:
+    return pids
+  for tid in tids:
+    pids += [int(p) for p in (_read(f"/proc/{pid}/task/{tid}/children") or "").split()]
+  return pids
+
+
+def children_reader():
+  """
+  :return: function of pid -> list of child pids, following the children
+           files of the kernel when it has them, else one scan of /proc
+  """
+  if PROC_CHILDREN:
+    return _task_children
+  children = process_children()
+  return lambda pid: children.get(pid, [])
+
+
+def process_rss(pid, children):
+  """
+  Resident memory of a process and all its descendants (terraform starts the
+  provider plugins as child processes)
+  :param pid: the process
+  :param children: function of pid -> list of child pids, see children_reader()
+  :return: number of bytes
+  """
+  rss = 0
+  pending = [pid]
+  while pending:
+    p = pending.pop()
+    status = _read(f"/proc/{p}/status")
+    if status is not None:
+      match = re.search(r'^VmRSS:\s+(\d+) kB', status, re.MULTILINE)
+      if match:
+        rss += int(match.group(1)) * 1024
+    pending.extend(children(p))
+  return rss
+
+
+def default_max_workers():
+  return max(1, cpu_count() * WORKERS_PER_CPU)
+
+
+def default_memory_budget():
+  limit = memory_limit()
+  if limit is None:
+    return None
+  return int(limit * MEMORY_BUDGET_RATIO)
+
+
+class AdmissionController:
+  """
+  Decides when another module run may start: there must be a free worker
+  and enough memory headroom for one more terraform process tree, based on
+  the RSS measured for the modules that are already running. Waiting modules
+  are admitted highest priority first, in arrival order among equals.
+  """
+  def __init__(self, max_workers=None, memory_budget=None):
+    self.max_workers = max_workers or default_max_workers()
+    self.memory_budget = memory_budget or default_memory_budget()
+    self.measured = 0
+    # key -> peak RSS of the running modules, and their RSS at the last sample
+    self.running = {}
+    self.current = {}
+    # heap of (-priority, arrival, key) of the modules waiting for a slot
+    self.waiting = []
+    self.arrivals = itertools.count()
+    self.condition = None
+    self.sampler = None
+
+  @property
+  def estimate(self):
+    """
+    Memory the next module is expected to need: the largest module measured so far
+    """
+    return self.measured or DEFAULT_MODULE_RSS
+
+  def describe(self):
+    budget = "unlimited" if self.memory_budget is None else f"{self.memory_budget // MB}MB"
+    return f"up to {self.max_workers} concurrent modules, memory budget {budget}"
+
+  @staticmethod
+  def _measure(processes):
+    """
+    :param processes: list of (pid, module key) of the running child processes
+    :return: dict of module key -> RSS of its process trees
+    """
+    rss = {}
+    children = children_reader() if processes else None
+    for pid, key in processes:
+      rss[key] = rss.get(key, 0) + process_rss(pid, children)
+    return rss
+
+  def _projected(self):
+    # a module that has not reached its peak yet is accounted with the estimate
+    return sum(max(self.current.get(key, 0), self.estimate) for key in self.running)
+
+  def _has_headroom(self):
+    if not self.running:
+      return True
+    if len(self.running) >= self.max_workers:
+      return False
+    return self.memory_budget is None or self._projected() + self.estimate <= self.memory_budget
+
+  async def _sampler(self):
+    """
+    Measure the running modules every SAMPLE_INTERVAL off the event loop,
+    admission decisions only read the figures of the last sample
+    """
+    while True:
+      await asyncio.sleep(SAMPLE_INTERVAL)
+      processes = [(proc.pid, key) for proc, key in list(running_processes.items())
+                   if key in self.running and proc.returncode is None]
+      rss = await asyncio.get_event_loop().run_in_executor(None, self._measure, processes)
+      async with self.condition:
+        # record the peaks even when no module is waiting for a slot
+        self.current = rss
+        for key, value in rss.items():
+          if key in self.running:
+            self.running[key] = max(self.running[key], value)
+        self.condition.notify_all()
+
+  async def acquire(self, key, priority=0):
+    """
+    Wait for headroom and the turn of the module, then take a worker slot
+    until release(). The module is in line as soon as this is called, before
+    the first await.
+    :param key: the module key its child processes are registered under
+    :param priority: modules with a higher one are admitted first
+    """
+    if self.condition is None:
+      self.condition = asyncio.Condition()
+      # memory is freed between the steps of a module too, re-check regularly
+      self.sampler = asyncio.ensure_future(self._sampler())
+
+    entry = (-priority, next(self.arrivals), key)
+    heapq.heappush(self.waiting, entry)
+    async with self.condition:
+      try:
+        await self.condition.wait_for(lambda: self.waiting[0] == entry and self._has_headroom())
+      finally:
+        self.waiting.remove(entry)
+        heapq.heapify(self.waiting)
+        # the next module in line may fit too
+        self.condition.notify_all()
+      self.running[key] = 0
+
+  def release(self, key):
+    """
+    Give the slot of a module back. The waiting modules are woken up by
+    a task scheduled after this call, so the modules queued before it
+    returns compete for the slot too.
+    """
+    self.measured = max(self.measured, self.running.pop(key))
+    self.current.pop(key, None)
+    asyncio.ensure_future(self._notify())
+
+  async def _notify(self):
+    if self.condition is not None:
+      async with self.condition:
+        self.condition.notify_all()
+
+  def close(self):
+    """
+    Stop sampling, to be called once all modules finished
+    """
+    if self.sampler is not None:
+      self.sampler.cancel()
+      self.sampler = None
+      self.condition = None
@@ -0,0 +1,97 @@
+from .tfplan import format_changes
+
+SUCCEEDED    = "succeeded"
+UNCHANGED    = "unchanged (cached)"
+NO_CHANGES   = "no changes (apply skipped)"
+USER_ABORTED = "aborted by user"
+FAILED       = "failed"
+BLOCKED      = "skipped (upstream failed)"
+CANCELLED    = "cancelled"
+NOT_RUN      = "not run"
+RESUMED      = "completed in the resumed run"
+
+# outcomes that do not fail the run
+OK_STATUSES = [SUCCEEDED, UNCHANGED, NO_CHANGES, USER_ABORTED, RESUMED]
+
+
+class ModuleResult:
+  """
+  Outcome of one workspace/module run
+  """
+  def __init__(self, workspace, module_path, status, phase=None, exit_code=None, message=None, changes=None):
+    self.workspace = workspace
+    self.module_path = module_path
+    self.status = status
+    self.phase = phase
+    self.exit_code = exit_code
+    self.message = message
+    self.changes = changes
+    self.duration = None
+    self.phases = {}
+
+  @property
+  def ok(self):
+    return self.status in OK_STATUSES
+
+  def as_dict(self):
+    return {"workspace": self.workspace, "module_path": self.module_path, "status": self.status,
+            "phase": self.phase, "exit_code": self.exit_code, "message": self.message,
+            "changes": self.changes, "duration": self.duration, "phases": self.phases}
+
+  @classmethod
+  def from_dict(cls, data):
+    result = cls(data["workspace"], data["module_path"], data["status"], data.get("phase"),
+                 data.get("exit_code"), data.get("message"), data.get("changes"))
+    result.duration = data.get("duration")
+    result.phases = data.get("phases") or {}
+    return result
+
+  def __repr__(self):
+    return f"ModuleResult({self.workspace}, {self.module_path}, {self.status})"
+
+
+def print_summary(workspace_results, workspace_orders):
+  """
+  Print the outcome of every module of every workspace of the run
+  :param workspace_results: dict of workspace -> dict of module -> ModuleResult
+  :param workspace_orders: dict of workspace -> modules in the order they were scheduled
+  """
+  rows = [("WORKSPACE", "MODULE", "STATUS", "CHANGES", "PHASE", "EXIT", "TIME")]
+  totals = {"add": 0, "change": 0, "destroy": 0}
+  planned = 0
+  for workspace, order in workspace_orders.items():
+    results = workspace_results.get(workspace, {})
+    for module_path in order:
+      result = results.get(module_path) or ModuleResult(workspace, module_path, NOT_RUN)
+      if result.changes is not None:
+        planned += 1
+        for change in totals:
+          totals[change] += result.changes[change]
+      rows.append((workspace,
+                   module_path,
+                   result.status,
+                   format_changes(result.changes),
+                   result.phase or "-",
+                   "-" if result.exit_code is None else str(result.exit_code),
+                   "-" if result.duration is None else f"{result.duration:.1f}s"))
+
+  widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+  print("\n******* Summary *********")
+  for row in rows:
+    print("  ".join(col.ljust(width) for col, width in zip(row, widths)).rstrip())
+  if planned:
+    print(f"Plan: {totals['add']} to add, {totals['change']} to change, {totals['destroy']} to destroy "
+          f"across {planned} module(s)")
+  print("**********************************")
+
+
+def run_exit_code(workspace_results):
+  """
+  :param workspace_results: dict of workspace -> dict of module -> ModuleResult
+  :return: process exit code for the run, 1 when any module did not finish successfully
+  """
+  for results in workspace_results.values():
+    for result in results.values():
+      if not result.ok:
+        return 1
+  return 0
@@ -1,10 +1,30 @@
+import asyncio
 import os
-import subprocess
+import shutil
+import threading
+import time
+from contextlib import contextmanager
 
 from .tfprompts import *
 from .tfutils import *
-
-import concurrent.futures
+from .tfcache import backend_fingerprint, cached_result, module_input_hash, read_fingerprint, record_result, \
+  setup_plugin_cache, write_fingerprint
+from .tfcredentials import broker, profile_override, provider_roles
+from .tfexec import ModuleLog, capture_command, module_key, run_command, terminate_running
+from .tfhistory import critical_path_priorities, expected_durations, record_runs
+from .tfjournal import run_journal, Journal
+from .tfgraph import build_dependency_graph, dependents_of, parse_remote_states, topological_order, DependencyCycleError
+from .tfresources import AdmissionController
+from .tflocks import backend_endpoint_config, lock_backoff, lock_contended, state_lock, DEFAULT_LOCK_RETRIES, \
+  DEFAULT_LOCK_TIMEOUT
+from .tfpreflight import preflight_report, preflight_results, run_preflight
+from .tfplan import find_plan, format_changes, plan_changes, save_plan, StalePlanError, PLAN_CHANGES, PLAN_NO_CHANGES
+from .tfresults import ModuleResult, print_summary, BLOCKED, CANCELLED, FAILED, NO_CHANGES, RESUMED, SUCCEEDED, \
+  UNCHANGED, USER_ABORTED
+from .tfstage import stage_module
+from .tfstate import get_state_serial, state_object_key
+from .tfthrottle import api_budget, throttled
+from .tftrace import run_tracer, Tracer, ORCHESTRATOR_TRACK
 
 LINK_FILES_LIST = [
   "_accounts.tf",
@@ -13,177 +33,665 @@ LINK_FILES_LIST = [
   "_providers.tf"
 ]
 
+TF_ACTIONS = ["plan", "apply", "plan-destroy", "apply-destroy"]
+
+# only one module at a time may ask the user for confirmation
+PROMPT_LOCK = threading.Lock()
+
+
+class ModuleError(Exception):
+  """
+  Raised when a step of a module run fails
+  """
+  def __init__(self, module_path, phase, exit_code):
+    self.module_path = module_path
+    self.phase = phase
+    self.exit_code = exit_code
+    super().__init__(f"{module_path}: {phase} failed with exit code {exit_code}")
+
+
 def tfrun(build_data):
   """
   Using python-terraform package we can invoke terraform statements
   such as terraform init, plan, apply etc. in python code
   :param build_data:
-  :return:
+  :return: dict of module -> ModuleResult
+  """
+  return tfrun_workspaces([build_data])[build_data["workspace"]]
+
+
+def tfrun_workspaces(build_data_list):
+  """
+  Run the same action in several workspaces at the same time. With more than
+  one workspace every workspace/module pair runs in its own staging directory.
+  :param build_data_list: one build_data per workspace
+  :return: dict of workspace -> dict of module -> ModuleResult
+  """
+  workspace_results = dict((build_data["workspace"], {}) for build_data in build_data_list)
+  try:
+    asyncio.run(execute_run(build_data_list, workspace_results))
+  except KeyboardInterrupt:
+    terminate_running()
+    print("Interrupted, aborting...")
+    raise
+  return workspace_results
+
+
+async def execute_run(build_data_list, workspace_results, limiter=None, report=print):
+  """
+  One run from start to end: pre-flight checks, module graphs, journal,
+  summary, run history and trace. Used by the CLI and by `pyrunner serve` jobs.
+  :param build_data_list: one build_data per workspace
+  :param workspace_results: dict of workspace -> dict of module -> ModuleResult, filled in as modules finish
+  :param limiter: AdmissionController shared with other runs, by default one is sized for this run
+  :param report: where the messages of the run go, e.g. to the clients following a job
+  """
+  tracer = Tracer()
+  trace_file = build_data_list[0].get("trace")
+  if trace_file:
+    tracer.enable()
+  # the module tasks started from here on inherit it
+  run_tracer.set(tracer)
+
+  with tracer.span("setup", ORCHESTRATOR_TRACK, "orchestrator"):
+    setup_plugin_cache()
+
+    # check every dependency graph before anything starts
+    schedules = [schedule_modules(build_data) for build_data in build_data_list]
+  if len(build_data_list) > 1:
+    for build_data in build_data_list:
+      build_data["isolate"] = True
+
+  workspace_orders = dict((build_data["workspace"], order) for build_data, (order, _) in zip(build_data_list, schedules))
+
+  if build_data_list[0].get("preflight"):
+    # catch syntax and reference errors offline, before any backend init or plan
+    with tracer.span("preflight", ORCHESTRATOR_TRACK, "orchestrator"):
+      failures = await run_preflight(build_data_list, LINK_FILES_LIST)
+    if failures:
+      for line in preflight_report(failures).splitlines():
+        report(line)
+      workspace_results.update(preflight_results(build_data_list, failures))
+      print_summary(workspace_results, workspace_orders)
+      return
+    report("Pre-flight checks passed")
+
+  journal = Journal(build_data_list)
+  run_journal.set(journal)
+  try:
+    with tracer.span("run", ORCHESTRATOR_TRACK, "orchestrator"):
+      await run_workspaces(build_data_list, schedules, workspace_results, limiter)
+  finally:
+    journal.close()
+    report(f"Run journal written to {journal.path}")
+    print_summary(workspace_results, workspace_orders)
+    record_runs(build_data_list, workspace_results)
+    if trace_file:
+      export_trace(tracer, trace_file, build_data_list, schedules, report)
+
+
+def export_trace(tracer, trace_file, build_data_list, schedules, report=print):
+  """
+  Write the Chrome trace and JSON summary of the run
+  """
+  deps = {}
+  for build_data, (_, workspace_deps) in zip(build_data_list, schedules):
+    workspace = build_data["workspace"]
+    for m, upstreams in workspace_deps.items():
+      deps[module_key(workspace, m)] = set(module_key(workspace, u) for u in upstreams)
+  summary_file = tracer.export(trace_file, deps)
+  report(f"Trace written to {trace_file}, summary to {summary_file}")
+
+
+def schedule_modules(build_data):
+  """
+  Work out the order modules have to run in for the action, exits on a dependency cycle
+  :param build_data:
+  :return: (order, deps) modules in dependency order and the modules each one waits for
+  """
+  try:
+    return module_schedule(build_data)
+  except DependencyCycleError as exc:
+    print(f"Error modules have a {exc} aborting...")
+    exit(1)
+
+
+def module_schedule(build_data):
   """
+  schedule_modules() raising DependencyCycleError instead of exiting
+  """
+  deps, missing = build_dependency_graph(build_data["modules"], build_data["workspace"])
+  for module, state_names in missing.items():
+    print(f"{module} reads remote state not built by this run: {', '.join(state_names)} (assuming already applied)")
+
+  order = topological_order(deps)
+  if build_data["tfaction"] in ("plan-destroy", "apply-destroy"):
+    # tear down consumers before the modules they read state from
+    order.reverse()
+    deps = dependents_of(deps)
+  return order, deps
+
+
+async def run_workspaces(build_data_list, schedules, workspace_results, limiter=None):
+  """
+  Run the module graphs of every workspace at the same time
+  :param limiter: AdmissionController shared with other runs, by default one is sized for this run
+  """
+  shared_limiter = limiter is not None
+  if not shared_limiter:
+    # size the number of concurrent modules from the cores and memory of the box
+    limiter = AdmissionController(build_data_list[0].get("max_workers"), build_data_list[0].get("memory_budget"))
+    print(f"Running {limiter.describe()}")
+
+  # set by the first failure in --fail-fast mode, stops every workspace
+  abort = asyncio.Event()
+  runs = [run_graph(order, deps, build_data, limiter, abort, workspace_results[build_data["workspace"]])
+          for build_data, (order, deps) in zip(build_data_list, schedules)]
+  try:
+    await asyncio.gather(*runs)
+  finally:
+    if not shared_limiter:
+      limiter.close()
+
+
+async def run_limited(limiter, module_path, build_data, priority=0):
+  """
+  Run a module once the limiter admits it. The slot of a module that ran is
+  not given back here: run_graph releases it once the modules it made ready
+  are in line, so a module off the critical path cannot take it first.
+  """
+  key = module_key(build_data["workspace"], module_path)
+  queued = time.monotonic()
+  await limiter.acquire(key, priority)
+  try:
+    run_tracer.get().add("queue", key, queued, time.monotonic(), "queue")
+    return await run_module(module_path, build_data)
+  except BaseException:
+    limiter.release(key)
+    raise
+
+
+def fail_fast(build_data):
+  """
+  Stop everything on the first failure? Serial runs do by default,
+  concurrent runs finish the work that does not depend on the failed module.
+  """
+  if build_data.get("fail_fast") is None:
+    return not build_data["multi_thread"]
+  return build_data["fail_fast"]
+
+
+async def run_graph(order, deps, build_data, limiter, abort, results):
+  """
+  Run modules, starting each one as soon as all of its upstream modules have
+  finished, all ready modules at once when running concurrently (longest
+  expected chain first, from the run history) or one at a time in dependency
+  order otherwise. Dependents of a failed module are not run; in fail-fast
+  mode a failure also cancels queued and running modules. With
+  build_data["resume"], modules the resumed run completed are skipped when
+  their sources and upstream modules did not change.
+  :param order: modules in dependency order
+  :param deps: dict of module -> set of modules it must wait for
+  :param build_data:
+  :param limiter: AdmissionController bounding the modules running at once
+  :param abort: event set when the whole run has to stop
+  :param results: dict of module -> ModuleResult, filled in as modules finish
+  """
+  workspace = build_data["workspace"]
+  parallel = len(order) if build_data["multi_thread"] else 1
+  waiting = {m: set(deps[m]) for m in order}
+  dependents = dependents_of(deps)
+  ready = [m for m in order if not waiting[m]]
+  completed = build_data.get("resume") or {}
+  journal = run_journal.get()
+
+  def release(mod):
+    for d in dependents[mod]:
+      waiting[d].discard(mod)
+      if not waiting[d] and d not in results:
+        ready.append(d)
+
+  ready_key = order.index
+  priorities = {}
   if build_data["multi_thread"]:
-    # if running inside a docker container make sure it's provision with 4GB to run all 10 threads successfully
-    with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-      future_to_run_module = {executor.submit(run_module, m, build_data): m for m in build_data["modules"]}
-      for future in concurrent.futures.as_completed(future_to_run_module):
-        mod = future_to_run_module[future]
-        try:
-          _data = future.result()
-        except Exception as exc:
-          print(f"{mod} generated an exception: {exc}")
-  else:
-    # loop through each selected module(s) and apply the action as specified by user
-    for m in build_data["modules"]:
-      print("\n\n****************************************************************************")
-      print("Permforming action \"{0}\" for module {1}".format(build_data["tfaction"], m))
-      print("****************************************************************************\n\n")
-      run_module(m, build_data)
+    # when running concurrently, start the ready module heading the longest expected chain first
+    priorities = critical_path_priorities(order, deps, expected_durations(build_data["tfaction"]), workspace)
+    ready_key = lambda m: (-priorities[m], order.index(m))
+
+  running = {}
+  # slots of the modules that finished, given back once their dependents are in line
+  finished = []
+
+  def hand_back(task, mod):
+    if not task.cancelled() and task.exception() is None:
+      finished.append(module_key(workspace, mod))
+
+  aborted = asyncio.ensure_future(abort.wait())
+  try:
+    while (ready or running) and not abort.is_set():
+      ready.sort(key=ready_key)
+      while ready and len(running) < parallel:
+        m = ready.pop(0)
+        if resumable(m, completed, deps, results):
+          print(f"{m} completed in the resumed run with the same inputs, skipping...")
+          results[m] = ModuleResult(workspace, m, RESUMED)
+          if journal is not None:
+            journal.module(results[m], completed[m])
+          release(m)
+          continue
+        if not build_data["multi_thread"]:
+          print("\n\n****************************************************************************")
+          print("Permforming action \"{0}\" for module {1}".format(build_data["tfaction"], m))
+          print("****************************************************************************\n\n")
+        running[asyncio.ensure_future(run_limited(limiter, m, build_data, priorities.get(m, 0)))] = m
+      while finished:
+        limiter.release(finished.pop())
+      if not running:
+        continue
+
+      done, _ = await asyncio.wait(list(running) + [aborted], return_when=asyncio.FIRST_COMPLETED)
+      for task in done:
+        if task is aborted:
+          continue
+        mod = running.pop(task)
+        hand_back(task, mod)
+        results[mod] = task_result(task, workspace, mod)
+        if results[mod].ok:
+          release(mod)
+          continue
+
+        if results[mod].status == FAILED and fail_fast(build_data):
+          print(f"{mod} failed, cancelling the remaining modules (fail-fast)...")
+          abort.set()
+        blocked = [mod]
+        while blocked:
+          for d in dependents[blocked.pop()]:
+            if d not in results:
+              print(f"{d} skipped: upstream module {mod} did not succeed")
+              results[d] = ModuleResult(workspace, d, BLOCKED)
+              blocked.append(d)
+
+    if running:
+      # fail-fast: stop queued modules and signal the running terraform processes
+      for task in running:
+        task.cancel()
+      await asyncio.wait(list(running))
+      for task, mod in running.items():
+        hand_back(task, mod)
+        results[mod] = task_result(task, workspace, mod)
+  finally:
+    aborted.cancel()
+    while finished:
+      limiter.release(finished.pop())
+
+
+def resumable(module_path, completed, deps, results):
+  """
+  :param completed: dict of module -> source hash of the modules the resumed run completed
+  :param deps: dict of module -> set of modules it must wait for
+  :param results: results of the modules finished so far
+  :return: True when the resumed run completed the module with the same
+           sources and all its upstream modules of this run were skipped too
+  """
+  if module_path not in completed or any(results[u].status != RESUMED for u in deps[module_path]):
+    return False
+  return completed[module_path] == source_hash(module_path)
+
+
+def source_hash(module_path):
+  """
+  Hash of the module sources and the variables/override files it runs with,
+  without the upstream state serials so it needs no S3 round trip
+  """
+  curr_path = os.getcwd()
+  input_files = [f"{curr_path}/variables/{f}" for f in LINK_FILES_LIST] + \
+                [f"{curr_path}/variables/config/{f}" for f in ["backend_override.tf", "providers_override.tf"]]
+  return module_input_hash(module_path.replace('./', ''), input_files, {})
+
+
+def task_result(task, workspace, module_path):
+  """
+  :return: ModuleResult of a finished module task
+  """
+  if task.cancelled():
+    return ModuleResult(workspace, module_path, CANCELLED)
+  exc = task.exception()
+  if exc is not None:
+    print(f"{module_path} generated an exception: {exc!r}")
+    return ModuleResult(workspace, module_path, FAILED, message=repr(exc))
+  return task.result()
+
+
+def upstream_states(module_path, build_data):
+  """
+  Look up the current serial of every remote state a module reads
+  :return: dict of state object key -> "<lineage>:<serial>"
+  """
+  states = {}
+  for ref_workspace, state_name in parse_remote_states(module_path):
+    workspace = ref_workspace or build_data["workspace"]
+    key = state_object_key(workspace, state_name)
+    if key not in states:
+      states[key] = get_state_serial(build_data["bucket"], build_data["bucket_region"], workspace, state_name,
+                                     build_data.get("role_arn"))
+  return states
+
+
+def terraform_env(build_data, providers_override, work_dir, log):
+  """
+  Environment of the terraform processes of a module. When the broker could
+  assume the roles of the providers, the override copied into work_dir is
+  replaced by one using their profiles.
+  :return: environment dict, None to inherit the orchestrator's
+  """
+  from botocore.exceptions import BotoCoreError, ClientError
+
+  role_arn = build_data.get("role_arn")
+  env = broker.env(role_arn) if role_arn else None
+  if not build_data.get("provider_profiles", True):
+    return env
+  with open(providers_override, 'r') as f:
+    override_text = f.read()
+  roles = provider_roles(override_text, build_data["workspace"], build_data.get("envs", {}))
+  if not roles:
+    return env
+  try:
+    env = broker.profiles_env(roles, role_arn)
+  except (BotoCoreError, ClientError) as error:
+    log.info(f"Unable to assume the provider roles ({error}), terraform assumes them itself")
+    return env
+  with open(os.path.join(work_dir, os.path.basename(providers_override)), 'w') as f:
+    f.write(profile_override(override_text))
+  return env
 
 
-def softlinking_files(module_path):
+def softlinking_files(module_path, log):
   curr_path = os.getcwd()
   rel_path = os.path.relpath(f"{curr_path}/variables", f"{curr_path}/{module_path}")
   for f in LINK_FILES_LIST:
     file_path = f"{curr_path}/{module_path}/{f}"
-    rm_ln_cmd = f"cd \"{curr_path}/{module_path}\" && rm {f}"
-    if os.path.exists(file_path) and os.path.islink(file_path):
-      print(f"removing old linking file {f}...")
-      process1 = subprocess.run(rm_ln_cmd, shell=True, check=False, stdout=subprocess.PIPE)
-      output1 = process1.stdout
-    print(f"linking file {f}...")
-    ln_cmd = f"cd \"{curr_path}/{module_path}\" && ln -s \"{rel_path}/{f}\" ."
-    process2 = subprocess.run(ln_cmd, shell=True, check=True, stdout=subprocess.PIPE)
-    output2 = process2.stdout
+    if os.path.islink(file_path):
+      if os.readlink(file_path) == f"{rel_path}/{f}":
+        continue
+      log.info(f"removing old linking file {f}...")
+      os.remove(file_path)
+    log.info(f"linking file {f}...")
+    os.symlink(f"{rel_path}/{f}", file_path)
+
 
+def _locked_confirmation(question):
+  with PROMPT_LOCK:
+    return user_confirmation(question)
 
-def run_module(module_path, build_data):
+
+async def confirm(question):
+  """
+  Ask the user for confirmation without blocking the other running modules
+  """
+  return await asyncio.get_event_loop().run_in_executor(None, _locked_confirmation, question)
+
+
+def journal_phase(workspace, module_path, phase):
+  journal = run_journal.get()
+  if journal is not None:
+    journal.phase(workspace, module_path, phase)
+
+
+@contextmanager
+def phase_span(phase, log):
+  """
+  Time a phase of a module run for the trace and the run history
+  """
+  start = time.monotonic()
+  try:
+    with run_tracer.get().span(phase, log.key):
+      yield
+  finally:
+    log.phases[phase] = log.phases.get(phase, 0.0) + time.monotonic() - start
+
+
+async def run_terraform(phase, args, module_path, work_dir, log, env=None, ok_codes=(0,), lock_retries=0, budget=None):
+  """
+  Run a terraform command in the module working directory
+  :param ok_codes: exit codes that are not an error
+  :param lock_retries: times to retry, with backoff, when the state lock is held by someone else
+                       or, except for an apply, when AWS throttled the command
+  :param budget: ApiBudget of the account, sets the -parallelism of the command
+  :return: the exit code
+  :raise ModuleError: when terraform exits with an error
+  """
+  attempt = 0
+  while True:
+    log.tail.clear()
+    with phase_span(phase, log):
+      if budget is None:
+        status = await run_command(["terraform"] + args, work_dir, log, env)
+      else:
+        async with budget.grant(log) as parallelism:
+          status = await run_command(["terraform", args[0], f"-parallelism={parallelism}"] + args[1:], work_dir, log, env)
+    if status in ok_codes:
+      return status
+    # a partly applied saved plan can't be applied again, only retry the rest
+    retry = lock_contended(log.tail) or (phase != "apply" and throttled(log.tail))
+    if attempt >= lock_retries or not retry:
+      log.info(f"{module_path}: Error aborting...")
+      raise ModuleError(module_path, phase, status)
+    delay = lock_backoff(attempt)
+    attempt += 1
+    reason = "state lock held elsewhere" if lock_contended(log.tail) else "throttled by AWS"
+    log.info(f"{module_path}: {reason}, retry {attempt}/{lock_retries} in {delay:.0f}s...")
+    with phase_span("lock-backoff" if lock_contended(log.tail) else "throttle-backoff", log):
+      await asyncio.sleep(delay)
+
+
+async def show_plan_changes(plan_file, module_path, work_dir, log, env=None):
+  """
+  Count the changes of a saved plan with `terraform show -json`
+  :return: dict with the add, change and destroy counts
+  :raise ModuleError: when terraform exits with an error
+  """
+  with phase_span("show", log):
+    status, plan_json = await capture_command(["terraform", "show", "-json", plan_file], work_dir, log, env)
+  if status != 0:
+    log.info(f"{module_path}: Error aborting...")
+    raise ModuleError(module_path, "show", status)
+  try:
+    return plan_changes(plan_json)
+  except ValueError as exc:
+    log.info(f"{module_path}: unreadable plan json: {exc}")
+    raise ModuleError(module_path, "show", status)
+
+
+async def run_module(module_path, build_data):
   """
   Loop through list of selected module(s) and build based on the selected account
-  :return:
+  :return: ModuleResult of the run
   """
+  workspace = build_data["workspace"]
+  log = ModuleLog(workspace, module_path)
+  budget = None
+  if build_data.get("api_budget"):
+    # the modules of an account share its API rate limits, whatever workspace they run in
+    budget = api_budget(build_data["environment"].get("account_id") or workspace, build_data["api_budget"])
+    budget.join()
+  started = time.monotonic()
+  try:
+    status, changes = await _run_module(module_path, build_data, log, budget)
+    result = ModuleResult(workspace, module_path, status, changes=changes)
+  except ModuleError as exc:
+    result = ModuleResult(workspace, module_path, FAILED, exc.phase, exc.exit_code, str(exc))
+  except asyncio.CancelledError:
+    log.info(f"{module_path}: cancelled")
+    raise
+  except Exception as exc:
+    log.info(f"{module_path} generated an exception: {exc!r}")
+    result = ModuleResult(workspace, module_path, FAILED, message=repr(exc))
+  finally:
+    if budget is not None:
+      budget.leave()
+    log.close()
+  result.duration = time.monotonic() - started
+  result.phases = log.phases
+
+  journal = run_journal.get()
+  if journal is not None:
+    # walks the module sources, off the event loop
+    hashed = await asyncio.get_event_loop().run_in_executor(None, source_hash, module_path) if result.ok else None
+    journal.module(result, hashed)
+  return result
 
+
+async def _run_module(module_path, build_data, log, budget=None):
   curr_path = os.getcwd()
   mod1 = (module_path.split('/')[-1])
   module_name = mod1.split('.')[0]
   mod_path = module_path.replace('./', '')
   workspace = build_data["workspace"]
+  tfaction = build_data["tfaction"]
+
+  if tfaction not in TF_ACTIONS:
+    log.info("Error unknown action aborting...")
+    raise ModuleError(module_path, "prepare", 1)
 
-  key_config = "\"key={0}/terraform.tfstate\"".format(module_name)
-  bucket_region_config = "\"region={0}\"".format(build_data["bucket_region"])
-  bucket_config = "\"bucket={0}\"".format(build_data["bucket"])
-  dynamodb_config = "\"dynamodb_table={0}\"".format(build_data["dynamodb"])
+  backend_config = [
+    "key={0}/terraform.tfstate".format(module_name),
+    "region={0}".format(build_data["bucket_region"]),
+    "bucket={0}".format(build_data["bucket"]),
+    "dynamodb_table={0}".format(build_data["dynamodb"])
+  ] + backend_endpoint_config()
 
   plan_output_file = "plan.out"
   backend_override = f"{curr_path}/variables/config/backend_override.tf"
   providers_override = f"{curr_path}/variables/config/providers_override.tf"
 
-  softlinking_files(mod_path)
-
-  remove_prev_run = f"cd {module_path} && rm -f {plan_output_file} && rm -rf .terraform"
-  cp_override_cmd = f"cd {module_path} && cp \"{backend_override}\" . && cp \"{providers_override}\" ."
-
+  # saved plans are only stored from plan runs and only used by --from-plans applies
+  from_plans = build_data.get("from_plans", False)
+  plan_store = build_data.get("plan_store") if from_plans or tfaction.startswith("plan") else None
 
-  tf_plan_cmd = f"cd {module_path} && \
-    terraform workspace select {workspace} || \
-    terraform workspace new {workspace} && \
-    terraform plan -out {plan_output_file}"
+  input_hash = None
+  if build_data.get("changed_only", False) or plan_store:
+    input_files = [f"{curr_path}/variables/{f}" for f in LINK_FILES_LIST] + [backend_override, providers_override]
+    with phase_span("hash-inputs", log):
+      states = await asyncio.get_event_loop().run_in_executor(None, upstream_states, mod_path, build_data)
+      input_hash = module_input_hash(mod_path, input_files, states)
+    if build_data.get("changed_only", False) and cached_result(workspace, tfaction, mod_path, input_hash):
+      log.info(f"Module {module_name} unchanged since last successful {tfaction}, skipping...")
+      return UNCHANGED, None
 
-  tf_plan_destroy_cmd = f"cd {module_path} && \
-    terraform workspace select {workspace} || \
-    terraform workspace new {workspace} && terraform plan -destroy \
-    -out {plan_output_file}"
+  if build_data.get("isolate", False):
+    # private working directory so other workspaces can run the same module at the same time
+    with phase_span("stage", log):
+      work_dir = stage_module(workspace, mod_path, LINK_FILES_LIST)
+  else:
+    work_dir = mod_path
 
-  tf_apply_cmd = f"cd {module_path} && \
-    terraform workspace select {workspace} || \
-    terraform workspace new {workspace} && \
-    terraform apply {plan_output_file}"
+  with phase_span("link", log):
+    softlinking_files(work_dir, log)
 
-  tf_init_cmd = f"cd {module_path} && \
-    terraform init --backend-config={key_config} \
-    --backend-config={bucket_region_config} \
-    --backend-config={dynamodb_config} \
-    --backend-config={bucket_config} && \
-    terraform workspace new {workspace} || \
-    terraform workspace select {workspace}"
+  with phase_span("cleanup", log):
+    plan_file_path = os.path.join(work_dir, plan_output_file)
+    if os.path.exists(plan_file_path):
+      os.remove(plan_file_path)
+    if build_data.get("clean", False):
+      # old behaviour: throw away providers, modules and backend state and init from scratch
+      shutil.rmtree(os.path.join(work_dir, ".terraform"), ignore_errors=True)
+    shutil.copy(backend_override, work_dir)
+    shutil.copy(providers_override, work_dir)
 
-  print(tf_init_cmd) # let's leave this in
+  # credentials of the run role and of the roles the providers switch to, assumed
+  # once and shared by every terraform process instead of once per provider and process
+  with phase_span("credentials", log):
+    env = await asyncio.get_event_loop().run_in_executor(None, terraform_env, build_data, providers_override,
+                                                         work_dir, log)
 
-  # exit immediately when errors
-  status = os.system(remove_prev_run)
-  if status != 0:
-    print(f"{module_name}: Error aborting...")
-    exit(1)
+  # only init when something init depends on changed since the last successful init
+  fingerprint = backend_fingerprint(mod_path, backend_config, [backend_override, providers_override])
+  if read_fingerprint(work_dir) == fingerprint:
+    log.info(f"{module_name}: backend config unchanged, skipping init...")
+  else:
+    init_args = ["init", "-reconfigure"] + [f"-backend-config={c}" for c in backend_config]
+    await run_terraform("init", init_args, module_path, work_dir, log, env)
+    # taken again: init writes the lock file when the module has none checked in
+    write_fingerprint(work_dir, backend_fingerprint(mod_path, backend_config, [backend_override, providers_override]))
+  journal_phase(workspace, module_path, "init")
 
-  status = os.system(cp_override_cmd)
-  if status != 0:
-    print(f"{module_name}: Error aborting...")
-    exit(1)
+  # runs of this process targeting the same state wait for each other instead of
+  # failing on the DynamoDB lock; terraform waits -lock-timeout for other holders
+  lock_args = [f"-lock-timeout={build_data.get('lock_timeout') or DEFAULT_LOCK_TIMEOUT}"]
+  lock_retries = build_data.get("lock_retries", DEFAULT_LOCK_RETRIES)
+  lock = state_lock(build_data["bucket"], state_object_key(workspace, module_name))
+  if lock.locked():
+    log.info(f"{module_name}: waiting for another run of the same state...")
+  with phase_span("state-lock", log):
+    await lock.acquire()
+  try:
+    with phase_span("workspace", log):
+      status = await run_command(["terraform", "workspace", "select", workspace], work_dir, log, env)
+    if status != 0:
+      await run_terraform("workspace", ["workspace", "new", workspace], module_path, work_dir, log, env)
 
-  status = os.system(tf_init_cmd)
-  if status != 0:
-    print(f"{module_name}: Error aborting...")
-    exit(1)
+    state_serial = None
+    if plan_store:
+      with phase_span("state-serial", log):
+        state_serial = await asyncio.get_event_loop().run_in_executor(
+          None, get_state_serial, build_data["bucket"], build_data["bucket_region"], workspace, module_name,
+          build_data.get("role_arn"))
 
-  if build_data["tfaction"] == 'plan':
-    # always auto approve 'plan' action
-    status = os.system(tf_plan_cmd)
-    if status != 0:
-      print(f"{module_name}: Error aborting...")
-      exit(1)
-  elif build_data["tfaction"] == 'plan-destroy':
     # always auto approve 'plan' action
-    status = os.system(tf_plan_destroy_cmd)
-    if status != 0:
-      print(f"{module_name}: Error aborting...")
-      exit(1)
-  elif build_data["tfaction"] == 'apply':
-    if str2bool(build_data["auto_approve"]):
-      # auto-approve flag enabled so skip user confirmation
-      status = os.system(tf_plan_cmd)
-      if status != 0:
-        print(f"{module_name}: Error aborting...")
-        exit(1)
-      status = os.system(tf_apply_cmd)
-      if status != 0:
-        print(f"{module_name}: Error aborting...")
-        exit(1)
+    destroy = tfaction.endswith("destroy")
+    if from_plans:
+      # apply exactly what was planned and reviewed earlier, if nothing moved on since
+      try:
+        saved_plan, metadata = find_plan(plan_store, workspace, mod_path, input_hash, state_serial, destroy)
+      except StalePlanError as exc:
+        log.info(f"{module_path}: {exc}, aborting...")
+        raise ModuleError(module_path, "saved-plan", 1)
+      log.info(f"{module_name}: using saved plan {saved_plan}")
+      shutil.copyfile(saved_plan, plan_file_path)
+      plan_status = PLAN_CHANGES if metadata["has_changes"] else PLAN_NO_CHANGES
+      changes = metadata["changes"]
     else:
-      status = os.system(tf_plan_cmd)
-      if status != 0:
-        print(f"{module_name}: Error aborting...")
-        exit(1)
-      # confirm with user first
-      if user_confirmation("Sure you want to APPLY {0}".format(module_name)):
-        status = os.system(tf_apply_cmd)
-        if status != 0:
-          print(f"{module_name}: Error aborting...")
-          exit(1)
-      else:
-        print("User aborting...")
-  elif build_data["tfaction"] == 'apply-destroy':
-    if str2bool(build_data["auto_approve"]):
-      status = os.system(tf_plan_destroy_cmd)
-      if status != 0:
-        print(f"{module_name}: Error aborting...")
-        exit(1)
-      status = os.system(tf_apply_cmd)
-      if status != 0:
-        print(f"{module_name}: Error aborting...")
-        exit(1)
-    else:
-      # confirm with user first
-      status = os.system(tf_plan_destroy_cmd)
-      if status != 0:
-        print(f"{module_name}: Error aborting...")
-        exit(1)
-      if user_confirmation("Sure you want to APPLY DESTROY {0}".format(module_name)):
-        status = os.system(tf_apply_cmd)
-        if status != 0:
-          print(f"{module_name}: Error aborting...")
-          exit(1)
-      else:
-        print("User aborting...")
-  else:
-    print("Error unknown action aborting...")
-    exit(1)
+      plan_args = ["plan", "-detailed-exitcode"] + lock_args + (["-destroy"] if destroy else []) + ["-out", plan_output_file]
+      plan_status = await run_terraform("plan", plan_args, module_path, work_dir, log, env,
+                                        ok_codes=(PLAN_NO_CHANGES, PLAN_CHANGES), lock_retries=lock_retries,
+                                        budget=budget)
+
+      changes = {"add": 0, "change": 0, "destroy": 0}
+      if plan_status == PLAN_CHANGES:
+        changes = await show_plan_changes(plan_output_file, module_path, work_dir, log, env)
+
+      if plan_store:
+        if input_hash is None or state_serial is None:
+          log.info(f"{module_name}: unable to read the module inputs or state, plan not saved")
+        else:
+          stored_plan = save_plan(plan_store, workspace, mod_path, input_hash, state_serial, plan_file_path, destroy,
+                                  plan_status == PLAN_CHANGES, changes)
+          log.info(f"{module_name}: plan saved to {stored_plan}")
+    log.info(f"{module_name}: plan {format_changes(changes)}")
+    journal_phase(workspace, module_path, "plan")
+
+    if tfaction.startswith("apply"):
+      if plan_status == PLAN_NO_CHANGES:
+        # nothing to apply, save the provider start and the state lock round trip
+        log.info(f"Module {module_name} has no changes, skipping apply...")
+        record_result(workspace, tfaction, mod_path, input_hash)
+        return NO_CHANGES, changes
+      if not str2bool(build_data["auto_approve"]):
+        # confirm with user first
+        question = "Sure you want to APPLY DESTROY {0} ({1})" if destroy else "Sure you want to APPLY {0} ({1})"
+        with phase_span("confirm", log):
+          confirmed = await confirm(question.format(module_name, format_changes(changes)))
+        if not confirmed:
+          log.info("User aborting...")
+          return USER_ABORTED, changes
+      await run_terraform("apply", ["apply"] + lock_args + [plan_output_file], module_path, work_dir, log, env,
+                          lock_retries=lock_retries, budget=budget)
+      journal_phase(workspace, module_path, "apply")
 
-  print(f"Module {module_name} ran successfully...")
+    if tfaction.startswith("apply") or plan_status == PLAN_NO_CHANGES:
+      # a plan with pending changes is planned again by the next --changed-only run
+      record_result(workspace, tfaction, mod_path, input_hash)
+    log.info(f"Module {module_name} ran successfully...")
+    return SUCCEEDED, changes
+  finally:
+    lock.release()
@@ -0,0 +1,258 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import itertools
+import json
+import os
+import socket
+
+from .tfcache import PYRUNNER_DIR, setup_plugin_cache
+from .tfexec import log_listeners, terminate_running
+from .tfgraph import module_state_name
+from .tfresources import parse_size, AdmissionController
+from .tfresults import ModuleResult, print_summary, run_exit_code
+from .tfrun import execute_run
+
+SOCKET_PATH = os.path.join(PYRUNNER_DIR, "pyrunner.sock")
+
+# module output kept per job, so clients joining a deduplicated job get all of it
+JOB_LOG_LIMIT = 100000
+
+PLAN_ACTIONS = ["plan", "plan-destroy"]
+
+
+class JobError(Exception):
+  """
+  Raised when a submitted job can't be run
+  """
+
+
+class Job:
+  """
+  One submitted pyrunner deploy run and the clients following it
+  """
+  def __init__(self, job_id, argv, build_data_list):
+    self.id = job_id
+    self.argv = argv
+    self.build_data_list = build_data_list
+    self.action = build_data_list[0]["tfaction"]
+    self.key = json.dumps(build_data_list, sort_keys=True, default=str)
+    self.state_keys = set((bd["workspace"], module_state_name(m)) for bd in build_data_list for m in bd["modules"])
+    self.status = "queued"
+    self.lines = []
+    self.subscribers = []
+    self.results = None
+
+  def publish(self, line):
+    if len(self.lines) < JOB_LOG_LIMIT:
+      self.lines.append(line)
+    for queue in self.subscribers:
+      queue.put_nowait({"event": "log", "line": line})
+
+  def subscribe(self):
+    queue = asyncio.Queue()
+    for line in self.lines:
+      queue.put_nowait({"event": "log", "line": line})
+    if self.results is not None:
+      queue.put_nowait(self.done_event())
+    self.subscribers.append(queue)
+    return queue
+
+  def done_event(self):
+    results = [r.as_dict() for ws_results in self.results.values() for r in ws_results.values()]
+    return {"event": "done", "job": self.id, "results": results, "exit_code": run_exit_code(self.results)}
+
+  def finish(self, results):
+    self.status = "done"
+    self.results = results
+    for queue in self.subscribers:
+      queue.put_nowait(self.done_event())
+
+
+class Server:
+  """
+  Runs the jobs submitted over a Unix socket in one long-lived process, so the
+  parsed config, module index, assumed credentials and initialised working
+  directories stay warm between jobs.
+  Identical pending plan jobs are merged and jobs sharing a state key run one
+  after the other, in submission order.
+  """
+  def __init__(self, build_job, socket_path=SOCKET_PATH, max_workers=None, memory_budget=None):
+    """
+    :param build_job: callable turning pyrunner arguments into a list of build_data
+    :param socket_path: Unix socket to listen on
+    """
+    self.build_job = build_job
+    self.socket_path = socket_path
+    self.max_workers = max_workers
+    self.memory_budget = memory_budget
+    self.ids = itertools.count(1)
+    self.queue = []
+    self.running = set()
+    self.limiter = None
+
+  async def serve(self):
+    setup_plugin_cache()
+    self.limiter = AdmissionController(self.max_workers, self.memory_budget)
+    os.makedirs(os.path.dirname(self.socket_path) or ".", exist_ok=True)
+    if os.path.exists(self.socket_path):
+      os.remove(self.socket_path)
+    server = await asyncio.start_unix_server(self.handle_client, path=self.socket_path)
+    print(f"pyrunner serving on {self.socket_path}, running {self.limiter.describe()}")
+    try:
+      async with server:
+        await server.serve_forever()
+    finally:
+      self.limiter.close()
+      if os.path.exists(self.socket_path):
+        os.remove(self.socket_path)
+
+  def submit(self, argv):
+    """
+    Queue a job, or join the identical plan job already waiting in the queue
+    :return: (job, deduplicated)
+    """
+    output = io.StringIO()
+    try:
+      # building the job prints its module lists and argument errors, pass them on to the client
+      with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+        build_data_list = self.build_job(argv)
+    except SystemExit:
+      raise JobError(output.getvalue().strip() or "invalid job")
+    if not build_data_list:
+      raise JobError(output.getvalue().strip() or "no modules to run")
+
+    job = Job(next(self.ids), argv, build_data_list)
+    if job.action not in PLAN_ACTIONS and not all(bd["auto_approve"] for bd in build_data_list):
+      raise JobError("apply jobs can't prompt for confirmation, submit them with --approve")
+    if job.action in PLAN_ACTIONS:
+      for queued in self.queue:
+        if queued.key == job.key:
+          return queued, True
+
+    self.queue.append(job)
+    self.schedule()
+    return job, False
+
+  def schedule(self):
+    """
+    Start every queued job not sharing a state key with a running job or an
+    earlier queued one
+    """
+    held = set()
+    for job in self.running:
+      held |= job.state_keys
+    for job in list(self.queue):
+      if not job.state_keys & held:
+        self.queue.remove(job)
+        self.running.add(job)
+        asyncio.ensure_future(self.run_job(job))
+      held |= job.state_keys
+
+  async def run_job(self, job):
+    job.status = "running"
+    log_listeners.set((job.publish,))
+    results = dict((bd["workspace"], {}) for bd in job.build_data_list)
+    try:
+      for build_data in job.build_data_list:
+        # private working directories: jobs of other workspaces may run the same module
+        build_data["isolate"] = True
+      await execute_run(job.build_data_list, results, self.limiter, job.publish)
+    except (Exception, SystemExit) as exc:
+      job.publish(f"job {job.id} failed: {exc!r}")
+    finally:
+      self.running.discard(job)
+      job.finish(results)
+      self.schedule()
+
+  async def handle_client(self, reader, writer):
+    try:
+      request = json.loads(await reader.readline())
+      try:
+        job, deduplicated = self.submit(request["argv"])
+      except JobError as exc:
+        await self.send(writer, {"event": "error", "message": str(exc)})
+        return
+      await self.send(writer, {"event": "queued", "job": job.id, "deduplicated": deduplicated,
+                               "position": self.queue.index(job) + 1 if job in self.queue else 0})
+      queue = job.subscribe()
+      try:
+        while True:
+          event = await queue.get()
+          await self.send(writer, event)
+          if event["event"] == "done":
+            break
+      finally:
+        job.subscribers.remove(queue)
+    except (ConnectionError, ValueError, KeyError):
+      pass
+    finally:
+      writer.close()
+
+  async def send(self, writer, event):
+    writer.write((json.dumps(event) + "\n").encode())
+    await writer.drain()
+
+
+def serve_main(argv, build_job):
+  """
+  pyrunner serve [--socket PATH]: run the job daemon until interrupted
+  """
+  parser = argparse.ArgumentParser(prog="pyrunner.py serve", description="Run pyrunner jobs submitted over a Unix socket")
+  parser.add_argument('--socket', default=SOCKET_PATH, help=f'Unix socket to listen on (default: {SOCKET_PATH})')
+  parser.add_argument('--max-workers', type=int, default=None, help='Maximum number of modules running at once over all jobs')
+  parser.add_argument('--memory-budget', type=parse_size, default=None,
+                      help='Memory the terraform processes of all jobs may use, e.g. 4G '
+                           '(default: 80%% of the memory/cgroup limit)')
+  args = parser.parse_args(argv)
+
+  server = Server(build_job, args.socket, args.max_workers, args.memory_budget)
+  try:
+    asyncio.run(server.serve())
+  except KeyboardInterrupt:
+    terminate_running()
+    print("Interrupted, stopping...")
+  return 0
+
+
+def submit_main(argv):
+  """
+  pyrunner submit [--socket PATH] -- <deploy arguments>: run a job on the
+  daemon, streaming its output
+  :return: exit code of the job
+  """
+  parser = argparse.ArgumentParser(prog="pyrunner.py submit", description="Submit a deploy job to pyrunner serve")
+  parser.add_argument('--socket', default=SOCKET_PATH, help=f'Unix socket of the daemon (default: {SOCKET_PATH})')
+  parser.add_argument('job', nargs=argparse.REMAINDER, help='pyrunner deploy arguments, e.g. -- -t plan -w dev')
+  args = parser.parse_args(argv)
+  job_argv = args.job[1:] if args.job[:1] == ["--"] else args.job
+
+  client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    client.connect(args.socket)
+  except OSError as error:
+    print(f"Unable to reach pyrunner serve on {args.socket}: {error}")
+    return 1
+  with client, client.makefile('rw') as stream:
+    stream.write(json.dumps({"argv": job_argv}) + "\n")
+    stream.flush()
+    for line in stream:
+      event = json.loads(line)
+      if event["event"] == "log":
+        print(event["line"])
+      elif event["event"] == "queued":
+        joined = " (joined an identical queued plan)" if event["deduplicated"] else ""
+        print(f"job {event['job']} queued{joined}")
+      elif event["event"] == "error":
+        print(f"job rejected: {event['message']}")
+        return 1
+      elif event["event"] == "done":
+        results = [ModuleResult.from_dict(r) for r in event["results"]]
+        workspace_results = {}
+        for result in results:
+          workspace_results.setdefault(result.workspace, {})[result.module_path] = result
+        print_summary(workspace_results, dict((ws, list(r)) for ws, r in workspace_results.items()))
+        return event["exit_code"]
+  print("Connection to pyrunner serve lost")
+  return 1
@@ -0,0 +1,86 @@
+import argparse
+
+from .tfgraph import build_dependency_graph
+from .tfhistory import estimate
+
+
+def parse_shard(value):
+  """
+  argparse type of --shard I/N
+  :return: (I, N) with 1 <= I <= N
+  """
+  try:
+    index, count = [int(v) for v in value.split('/')]
+  except ValueError:
+    raise argparse.ArgumentTypeError(f"expected I/N, e.g. 1/4, got {value!r}")
+  if count < 1 or not 1 <= index <= count:
+    raise argparse.ArgumentTypeError(f"shard {value!r} out of range, expected 1 <= I <= N")
+  return index, count
+
+
+def connected_components(modules, deps):
+  """
+  Group modules linked by a dependency in either direction
+  :return: list of module lists, modules keep their input order
+  """
+  parent = dict((m, m) for m in modules)
+
+  def find(m):
+    while parent[m] != m:
+      parent[m] = parent[parent[m]]
+      m = parent[m]
+    return m
+
+  for module, upstreams in deps.items():
+    for upstream in upstreams:
+      parent[find(module)] = find(upstream)
+
+  groups = {}
+  for module in modules:
+    groups.setdefault(find(module), []).append(module)
+  return list(groups.values())
+
+
+def shard_build_data(build_data_list, shard, durations=None):
+  """
+  Keep the modules of one shard out of N, spread with longest-processing-time
+  first on their expected durations. Plans do not wait for each other, their
+  modules are spread one by one; for applies every dependency-connected group
+  of modules of a workspace goes to a single shard, so a shard never waits
+  for another one. The split only depends on the modules and the
+  durations, so runners given the same durations compute the same one.
+  :param build_data_list: one build_data per workspace
+  :param shard: (I, N) from parse_shard
+  :param durations: expected durations from load_durations, None to count
+                    every module as DEFAULT_DURATION
+  :return: (build_data_list of the shard, list of the estimated seconds of every shard)
+  """
+  index, count = shard
+  # not the local run history: every runner has its own, the splits would differ
+  durations = {} if durations is None else durations
+
+  groups = []
+  for build_data in build_data_list:
+    workspace = build_data["workspace"]
+    if build_data["tfaction"].startswith("plan"):
+      # a plan reads the current state of its upstream modules, whichever shard plans them
+      module_groups = [[m] for m in build_data["modules"]]
+    else:
+      deps, _ = build_dependency_graph(build_data["modules"], workspace)
+      module_groups = connected_components(build_data["modules"], deps)
+    for group in module_groups:
+      groups.append((sum(estimate(durations, workspace, m) for m in group), workspace, group))
+
+  loads = [0.0] * count
+  assigned = [set() for _ in range(count)]
+  for group_estimate, workspace, group in sorted(groups, key=lambda g: (-g[0], g[1], g[2])):
+    target = min(range(count), key=lambda i: (loads[i], i))
+    loads[target] += group_estimate
+    assigned[target].update((workspace, m) for m in group)
+
+  shard_list = []
+  for build_data in build_data_list:
+    modules = [m for m in build_data["modules"] if (build_data["workspace"], m) in assigned[index - 1]]
+    if modules:
+      shard_list.append(dict(build_data, modules=modules))
+  return shard_list, loads
@@ -0,0 +1,65 @@
+import os
+import shutil
+
+from .tfcache import PYRUNNER_DIR, GENERATED_FILES, LOCK_FILE
+
+STAGING_DIR = os.path.join(PYRUNNER_DIR, "work")
+
+# shared directories of the build directory that modules refer to by relative path
+STAGING_LINKS = ["modules", "variables"]
+
+
+def staging_root(workspace, staging_dir=STAGING_DIR):
+  """
+  Every workspace gets a mirror of the build directory so relative module
+  sources (../../../modules/...) and the variables links resolve as usual
+  :param workspace: terraform workspace, empty for a staging root of its own
+  :param staging_dir: directory holding the staging roots
+  :return: path of the workspace staging root
+  """
+  root = os.path.join(staging_dir, workspace) if workspace else staging_dir
+  os.makedirs(root, exist_ok=True)
+  for name in STAGING_LINKS:
+    link_path = os.path.join(root, name)
+    if not os.path.lexists(link_path):
+      os.symlink(os.path.abspath(name), link_path)
+  return root
+
+
+def stage_module(workspace, module_path, link_files, staging_dir=STAGING_DIR):
+  """
+  Create (or refresh) the isolated working directory of a workspace/module
+  pair. Module sources are linked in, .terraform, plan.out and the lock file
+  stay private to the staging directory.
+  :param workspace: terraform workspace
+  :param module_path: path of the module e.g. main/networkings/vpc
+  :param link_files: variables files linked in by softlinking_files()
+  :param staging_dir: directory holding the staging roots
+  :return: path of the staged module directory
+  """
+  mod_path = os.path.normpath(module_path)
+  work_dir = os.path.join(staging_root(workspace, staging_dir), mod_path)
+  os.makedirs(work_dir, exist_ok=True)
+
+  skip = set(GENERATED_FILES + link_files + [".terraform", LOCK_FILE])
+  sources = set(name for name in os.listdir(mod_path) if name not in skip)
+
+  # drop links to files that were removed from the module
+  for name in os.listdir(work_dir):
+    link_path = os.path.join(work_dir, name)
+    if name not in skip and os.path.islink(link_path) and name not in sources:
+      os.remove(link_path)
+
+  for name in sorted(sources):
+    link_path = os.path.join(work_dir, name)
+    if not os.path.lexists(link_path):
+      os.symlink(os.path.abspath(os.path.join(mod_path, name)), link_path)
+
+  # terraform init may update the lock file, keep the checked in one untouched
+  lock_file = os.path.join(mod_path, LOCK_FILE)
+  staged_lock_file = os.path.join(work_dir, LOCK_FILE)
+  if os.path.exists(lock_file) and (not os.path.exists(staged_lock_file)
+                                    or os.path.getmtime(lock_file) > os.path.getmtime(staged_lock_file)):
+    shutil.copy2(lock_file, staged_lock_file)
+
+  return work_dir
@@ -0,0 +1,51 @@
+import json
+import re
+
+from .tfcredentials import broker
+from .tflocks import s3_endpoint
+
+# the serial is near the top of a state file, no need to download all of it
+STATE_HEAD_BYTES = 1024
+SERIAL_RE  = re.compile(r'"serial"\s*:\s*(\d+)')
+LINEAGE_RE = re.compile(r'"lineage"\s*:\s*"([^"]*)"')
+
+
+def state_object_key(workspace, state_name):
+  """
+  S3 object key terraform uses for key=<state_name>/terraform.tfstate
+  :param workspace: terraform workspace
+  :param state_name: name of the module state
+  :return: the object key
+  """
+  if workspace == "default":
+    return f"{state_name}/terraform.tfstate"
+  return f"env:/{workspace}/{state_name}/terraform.tfstate"
+
+
+def get_state_serial(bucket, region, workspace, state_name, role_arn=None):
+  """
+  Read the lineage and serial of a module state from the S3 backend
+  :param role_arn: role to read the state with, None for the caller credentials
+  :return: "<lineage>:<serial>", "absent" when there is no state yet, or None
+           when the state could not be read
+  """
+  from botocore.exceptions import BotoCoreError, ClientError
+
+  s3 = broker.client('s3', region, role_arn, s3_endpoint())
+  key = state_object_key(workspace, state_name)
+  try:
+    head = s3.get_object(Bucket=bucket, Key=key, Range=f"bytes=0-{STATE_HEAD_BYTES - 1}")['Body'].read().decode()
+    serial = SERIAL_RE.search(head)
+    lineage = LINEAGE_RE.search(head)
+    if serial is None or lineage is None:
+      state = json.loads(s3.get_object(Bucket=bucket, Key=key)['Body'].read())
+      return f"{state['lineage']}:{state['serial']}"
+    return f"{lineage.group(1)}:{serial.group(1)}"
+  except ClientError as error:
+    if error.response['Error']['Code'] in ('NoSuchKey', '404'):
+      return "absent"
+    print(f"Unable to read state {key}: {error}")
+    return None
+  except (BotoCoreError, ValueError, KeyError) as error:
+    print(f"Unable to read state {key}: {error}")
+    return None
@@ -0,0 +1,133 @@
+import asyncio
+import re
+import time
+import weakref
+from contextlib import asynccontextmanager
+
+from .tfexec import strip_colors
+
+# concurrent AWS API calls the terraform processes of one account may make,
+# terraform alone defaults to -parallelism=10 per process
+DEFAULT_API_BUDGET = 40
+
+# terraform's own default, a module running alone gets no more than that
+MAX_PARALLELISM = 10
+
+# AWS error codes telling the caller to slow down
+THROTTLING_ERRORS = ["Throttling", "ThrottlingException", "ThrottledException", "RequestLimitExceeded",
+                     "TooManyRequestsException", "SlowDown", "RequestThrottled", "RequestThrottledException"]
+
+# where terraform error messages name them: "api error <Code>: ..." (AWS SDK v2),
+# "<Code>: ..." (v1), or the HTTP status of a request the SDK gave up retrying
+THROTTLING_RE = re.compile(r"(?:\bapi error |^Error: (?:.*: )?)(?:" + "|".join(THROTTLING_ERRORS) + r"):"
+                           r"|\bStatusCode: (?:429|503)\b")
+
+# the budget is halved at most once per cooldown, every process running into
+# the same throttling episode reports it
+THROTTLE_COOLDOWN = 30
+
+# event loop -> dict of account -> ApiBudget
+_budgets = weakref.WeakKeyDictionary()
+
+
+def throttled(lines):
+  """
+  :param lines: output of a terraform command
+  :return: True when one of its errors is AWS throttling its API calls
+  """
+  in_error = False
+  for line in lines:
+    # terraform boxes every error in "│ " lines, the message may wrap over several
+    line = strip_colors(line)
+    text = line.strip().lstrip("│").strip()
+    if text.startswith("Error:"):
+      in_error = True
+    elif not line.lstrip().startswith("│"):
+      in_error = False
+    if in_error and THROTTLING_RE.search(text):
+      return True
+  return False
+
+
+class ApiBudget:
+  """
+  AWS API concurrency budget of one account, shared by its terraform
+  processes. Every plan/apply gets a -parallelism share: the current limit
+  split evenly over the modules of the account that are running, never more
+  than terraform's default nor than what the processes already running left
+  over. terraform fixes its parallelism when it starts, so the split is
+  rebalanced as every new process starts. The limit is halved when
+  a process is throttled and grows back by one with every process that was
+  not (additive increase, multiplicative decrease).
+  """
+  def __init__(self, account, size):
+    """
+    :param account: account the budget is for, only used in the log
+    :param size: maximum number of concurrent API calls
+    """
+    self.account = account
+    self.size = size
+    self.limit = size
+    self.in_use = 0
+    self.modules = 0
+    self.throttled_at = None
+    self.condition = asyncio.Condition()
+
+  def _share(self):
+    even_split = max(1, self.limit // max(1, self.modules))
+    return min(even_split, MAX_PARALLELISM, self.limit - self.in_use)
+
+  def join(self):
+    """
+    Count a module of the account in the split until leave()
+    """
+    self.modules += 1
+
+  def leave(self):
+    self.modules -= 1
+
+  def _feedback(self, log):
+    if not throttled(log.tail):
+      self.limit = min(self.size, self.limit + 1)
+      return
+    now = time.monotonic()
+    if self.throttled_at is None or now - self.throttled_at >= THROTTLE_COOLDOWN:
+      self.throttled_at = now
+      self.limit = max(1, self.limit // 2)
+      log.info(f"AWS API throttling, budget of account {self.account} lowered to {self.limit} concurrent calls")
+
+  @asynccontextmanager
+  async def grant(self, log):
+    """
+    Wait for a share of the budget and hold it while a terraform command runs
+    :param log: ModuleLog of the module, its tail is checked for throttling afterwards
+    :return: the -parallelism of the command
+    """
+    async with self.condition:
+      await self.condition.wait_for(lambda: self._share() >= 1)
+      share = self._share()
+      self.in_use += share
+    try:
+      yield share
+    finally:
+      async with self.condition:
+        self.in_use -= share
+        self._feedback(log)
+        self.condition.notify_all()
+
+
+def api_budget(account, size):
+  """
+  Budget shared by the runs of this process against the same account
+  :param account: AWS account id
+  :param size: maximum number of concurrent API calls, see --api-budget
+  :return: ApiBudget
+  """
+  budgets = _budgets.setdefault(asyncio.get_event_loop(), {})
+  if account not in budgets:
+    budgets[account] = ApiBudget(account, size)
+  elif budgets[account].size != size:
+    # a later job asked for another budget, it grows back to a larger one on its own
+    budgets[account].size = size
+    budgets[account].limit = min(budgets[account].limit, size)
+  return budgets[account]
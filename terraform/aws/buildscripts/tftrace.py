@@ -0,0 +1,116 @@
+import contextvars
+import json
+import os
+import time
+from contextlib import contextmanager
+
+# track of the spans that are not about a single module
+ORCHESTRATOR_TRACK = "orchestrator"
+
+
+class Tracer:
+  """
+  Records timed spans per track (a workspace/module pair) and exports them as
+  a Chrome trace-event file (chrome://tracing, ui.perfetto.dev) and a JSON summary
+  """
+  def __init__(self):
+    self.enabled = False
+    self.origin = time.monotonic()
+    self.spans = []
+    self.tracks = {}
+
+  def enable(self):
+    self.enabled = True
+    self.origin = time.monotonic()
+    self.spans = []
+    self.tracks = {ORCHESTRATOR_TRACK: 0}
+
+  def add(self, name, track, start, end, category="phase", **args):
+    """
+    Record a span, times are time.monotonic() values
+    """
+    if not self.enabled:
+      return
+    if track not in self.tracks:
+      self.tracks[track] = len(self.tracks)
+    self.spans.append({"name": name, "cat": category, "track": track,
+                       "start": start - self.origin, "end": end - self.origin, "args": args})
+
+  @contextmanager
+  def span(self, name, track, category="phase", **args):
+    """
+    Time the enclosed block, also across awaits
+    """
+    start = time.monotonic()
+    try:
+      yield
+    finally:
+      self.add(name, track, start, time.monotonic(), category, **args)
+
+  def chrome_trace(self):
+    events = []
+    for track, tid in self.tracks.items():
+      events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": tid, "args": {"name": track}})
+    for span in self.spans:
+      events.append({"name": span["name"], "cat": span["cat"], "ph": "X", "pid": 1,
+                     "tid": self.tracks[span["track"]],
+                     "ts": round(span["start"] * 1e6), "dur": round((span["end"] - span["start"]) * 1e6),
+                     "args": span["args"]})
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+  def summary(self, deps=None):
+    """
+    Totals per module and per phase and the critical path of the run
+    :param deps: dict of track -> set of upstream tracks, to work out the critical path
+    """
+    modules = {}
+    phases = {}
+    wall = 0.0
+    for span in self.spans:
+      duration = span["end"] - span["start"]
+      wall = max(wall, span["end"])
+      if span["track"] == ORCHESTRATOR_TRACK:
+        continue
+      module = modules.setdefault(span["track"], {"start": span["start"], "end": span["end"], "phases": {}})
+      module["start"] = min(module["start"], span["start"])
+      module["end"] = max(module["end"], span["end"])
+      module["phases"][span["name"]] = module["phases"].get(span["name"], 0.0) + duration
+      phases[span["name"]] = phases.get(span["name"], 0.0) + duration
+
+    for module in modules.values():
+      module["total"] = module["end"] - module["start"]
+
+    return {"wall_time": wall,
+            "phases": phases,
+            "modules": modules,
+            "critical_path": self.critical_path(modules, deps or {})}
+
+  def critical_path(self, modules, deps):
+    """
+    Follow the module that finished last back through the upstream that
+    finished last before it started
+    """
+    path = []
+    current = max(modules, key=lambda m: modules[m]["end"]) if modules else None
+    while current is not None:
+      path.append(current)
+      upstreams = [u for u in deps.get(current, ()) if u in modules]
+      current = max(upstreams, key=lambda m: modules[m]["end"]) if upstreams else None
+    return list(reversed(path))
+
+  def export(self, trace_file, deps=None):
+    """
+    Write the Chrome trace to trace_file and the summary next to it as <name>.summary.json
+    :return: path of the summary file
+    """
+    with open(trace_file, 'w') as f:
+      json.dump(self.chrome_trace(), f)
+    summary_file = os.path.splitext(trace_file)[0] + ".summary.json"
+    with open(summary_file, 'w') as f:
+      json.dump(self.summary(deps), f, indent=2, sort_keys=True)
+    return summary_file
+
+
+# tracer of the run the current task belongs to, every run sets its own so the
+# jobs of `pyrunner serve` don't mix their spans; the default one stays disabled
+run_tracer = contextvars.ContextVar("run_tracer", default=Tracer())
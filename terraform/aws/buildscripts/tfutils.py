@@ -1,5 +1,6 @@
 import argparse
-import boto3
+
+from .tfcredentials import broker
 
 def str2bool(v):
   if isinstance(v, bool):
@@ -19,17 +20,5 @@ def is_empty(chk_data):
     return True
 
 def get_credentials(role_arn):
-  # create an STS client object that represents a live connection to the
-  # STS service
-  sts_client = boto3.client('sts')
-
-  # Call the assume_role method of the STSConnection object and pass the role
-  # ARN and a role session name.
-  assumed_role_object = sts_client.assume_role(
-    RoleArn=role_arn,
-    RoleSessionName="AssumeRoleSessionCI"
-  )
-
-  # From the response that contains the assumed role, get the temporary
-  # credentials that can be used to make subsequent API calls
-  return assumed_role_object['Credentials']
\ No newline at end of file
+  # assumed roles are cached and refreshed by the shared credential broker
+  return broker.get(role_arn)
@@ -0,0 +1,300 @@
+import argparse
+import asyncio
+import ctypes
+import ctypes.util
+import os
+import struct
+import time
+
+from .tfaffected import affected_modules
+from .tfcache import setup_plugin_cache, GENERATED_FILES, LOCK_FILE, PYRUNNER_DIR
+from .tfexec import terminate_running
+from .tfgraph import DependencyCycleError
+from .tfhistory import record_runs
+from .tfmodules import module_index
+from .tfresources import AdmissionController
+from .tfresults import print_summary
+from .tfrun import module_schedule, run_workspaces, LINK_FILES_LIST
+
+# trees whose changes can change a plan
+WATCH_DIRS = ["main", "modules", "variables"]
+
+# quiet time that ends a burst of edits (editor swap files, git checkouts, formatters)
+DEFAULT_DEBOUNCE = 0.5
+
+POLL_INTERVAL = 1.0
+
+# inotify(7) flags and event masks
+IN_NONBLOCK    = 0o4000
+IN_CLOEXEC     = 0o2000000
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ISDIR       = 0x40000000
+WATCH_MASK     = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+# struct inotify_event without its name: wd, mask, cookie, len
+EVENT_HEADER = struct.Struct("iIII")
+
+
+def ignored_dir(name):
+  return name in (".terraform", ".git", os.path.basename(PYRUNNER_DIR))
+
+
+def relevant(path):
+  """
+  :param path: changed file path relative to the build directory
+  :return: False for the files written by the plans themselves and by editors
+  """
+  parts = path.split(os.sep)
+  name = parts[-1]
+  if any(ignored_dir(p) for p in parts[:-1]) or ignored_dir(name):
+    return False
+  if name in GENERATED_FILES or os.path.islink(path):
+    return False
+  if name in LINK_FILES_LIST and parts[0] != "variables":
+    return False
+  if name == LOCK_FILE:
+    # provider versions the plans use
+    return True
+  # hidden files, backups and vim's "4913" write test
+  return not (name.startswith('.') or name.endswith('~') or name.isdigit())
+
+
+class InotifyWatcher:
+  """
+  Recursive watch of directory trees with inotify, called through libc with
+  ctypes; directories created later are added as they appear
+  """
+  def __init__(self, dirs, on_change):
+    """
+    :param dirs: directory trees to watch
+    :param on_change: called with the path of every file or directory changed
+    """
+    self.dirs = dirs
+    self.on_change = on_change
+    self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if self.fd < 0:
+      raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+    self.paths = {}
+    try:
+      for dir_path in dirs:
+        self._add_tree(dir_path)
+    except OSError:
+      os.close(self.fd)
+      raise
+
+  def describe(self):
+    return f"inotify, {len(self.paths)} directories"
+
+  def _add_tree(self, root):
+    for path, subdirs, _ in os.walk(root):
+      subdirs[:] = [d for d in subdirs if not ignored_dir(d)]
+      wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+      if wd < 0:
+        # usually fs.inotify.max_user_watches
+        raise OSError(ctypes.get_errno(), f"inotify_add_watch {path} failed")
+      self.paths[wd] = path
+
+  def start(self):
+    asyncio.get_event_loop().add_reader(self.fd, self._read)
+
+  def _read(self):
+    try:
+      data = os.read(self.fd, 64 * 1024)
+    except BlockingIOError:
+      return
+    offset = 0
+    while offset < len(data):
+      wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+      name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b"\0")
+      offset += EVENT_HEADER.size + length
+      if mask & IN_Q_OVERFLOW:
+        # events were dropped, consider everything changed
+        for dir_path in self.dirs:
+          self.on_change(dir_path)
+        continue
+      if mask & IN_IGNORED:
+        self.paths.pop(wd, None)
+        continue
+      if wd not in self.paths:
+        continue
+      path = os.path.join(self.paths[wd], os.fsdecode(name))
+      if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) and not ignored_dir(os.fsdecode(name)):
+        try:
+          self._add_tree(path)
+        except OSError as error:
+          print(f"Unable to watch {path}: {error}")
+      self.on_change(path)
+
+  def close(self):
+    asyncio.get_event_loop().remove_reader(self.fd)
+    os.close(self.fd)
+
+
+class PollingWatcher:
+  """
+  Watch of directory trees comparing the mtime and size of every file at
+  a fixed interval, for systems without inotify
+  """
+  def __init__(self, dirs, on_change, interval=POLL_INTERVAL):
+    self.dirs = dirs
+    self.on_change = on_change
+    self.interval = interval
+    self.snapshot = self._snapshot()
+    self.task = None
+
+  def describe(self):
+    return f"polling every {self.interval:g}s"
+
+  def _snapshot(self):
+    files = {}
+    for root in self.dirs:
+      for path, subdirs, names in os.walk(root):
+        subdirs[:] = [d for d in subdirs if not ignored_dir(d)]
+        for name in names:
+          file_path = os.path.join(path, name)
+          try:
+            stat = os.stat(file_path)
+          except OSError:
+            continue
+          files[file_path] = (stat.st_mtime_ns, stat.st_size)
+    return files
+
+  def start(self):
+    self.task = asyncio.ensure_future(self._poll())
+
+  async def _poll(self):
+    while True:
+      await asyncio.sleep(self.interval)
+      snapshot = await asyncio.get_event_loop().run_in_executor(None, self._snapshot)
+      for path in set(snapshot) | set(self.snapshot):
+        if snapshot.get(path) != self.snapshot.get(path):
+          self.on_change(path)
+      self.snapshot = snapshot
+
+  def close(self):
+    if self.task is not None:
+      self.task.cancel()
+
+
+def make_watcher(dirs, on_change, polling=False):
+  """
+  :return: an InotifyWatcher, or a PollingWatcher when inotify is not available or polling is asked for
+  """
+  if not polling:
+    try:
+      return InotifyWatcher(dirs, on_change)
+    except (OSError, AttributeError) as error:
+      print(f"inotify not available ({error}), polling instead")
+  return PollingWatcher(dirs, on_change)
+
+
+async def next_batch(queue, debounce):
+  """
+  Wait for a change, then for the edits to go quiet for `debounce` seconds
+  :return: set of changed paths
+  """
+  changed = {await queue.get()}
+  while True:
+    try:
+      changed.add(await asyncio.wait_for(queue.get(), debounce))
+    except asyncio.TimeoutError:
+      return changed
+
+
+async def replan(build_data, modules, limiter, latest):
+  """
+  Plan some of the watched modules and print the latest plan of every one
+  :param modules: modules to plan, in deploy order
+  :param latest: dict of module -> ModuleResult of its latest plan, updated
+  """
+  workspace = build_data["workspace"]
+  batch = dict(build_data, modules=modules)
+  try:
+    schedule = module_schedule(batch)
+  except DependencyCycleError as exc:
+    # the edit is likely half done, the next one may break the cycle
+    print(f"\n[{time.strftime('%H:%M:%S')}] Not re-planning, modules have a {exc}")
+    return
+  started = time.monotonic()
+  results = {workspace: {}}
+  try:
+    await run_workspaces([batch], [schedule], results, limiter)
+  finally:
+    record_runs([batch], results)
+  latest.update(results[workspace])
+  print(f"\n[{time.strftime('%H:%M:%S')}] planned {len(modules)} module(s) in {time.monotonic() - started:.1f}s, "
+        f"latest plan of every watched module:")
+  print_summary({workspace: latest}, {workspace: build_data["modules"]})
+
+
+async def watch(build_data, module_dirs, debounce, polling):
+  """
+  Plan every module once, then re-plan the modules affected by every burst
+  of edits, with their remote state consumers, until interrupted
+  :param module_dirs: directories containing the terraform modules, e.g. ["main"]
+  """
+  setup_plugin_cache()
+  queue = asyncio.Queue()
+  watcher = make_watcher(WATCH_DIRS, lambda path: relevant(path) and queue.put_nowait(path), polling)
+  watcher.start()
+  limiter = AdmissionController(build_data.get("max_workers"), build_data.get("memory_budget"))
+  latest = {}
+  try:
+    # working directories stay initialised, later plans skip init
+    await replan(build_data, build_data["modules"], limiter, latest)
+    print(f"Watching {', '.join(WATCH_DIRS)} ({watcher.describe()}), Ctrl-C to stop")
+    while True:
+      changed = sorted(await next_batch(queue, debounce))
+      modules = affected_modules(changed, module_index(module_dirs), build_data["workspace"], build_data["modules"])
+      print(f"\n{len(changed)} file(s) changed: {', '.join(changed[:5])}{' ...' if len(changed) > 5 else ''}")
+      if not modules:
+        print("No watched module affected")
+        continue
+      print(f"Re-planning {', '.join(modules)}")
+      await replan(build_data, modules, limiter, latest)
+  finally:
+    watcher.close()
+    limiter.close()
+
+
+def watch_main(argv, build_job, module_dirs):
+  """
+  pyrunner watch -w WORKSPACE [-m MODULES]: re-plan modules as they are edited
+  :param build_job: callable turning pyrunner deploy arguments into a list of build_data
+  :param module_dirs: directories containing the terraform modules
+  :return: exit code
+  """
+  parser = argparse.ArgumentParser(prog="pyrunner.py watch",
+                                   description="Plan the modules of a workspace again whenever their inputs change, "
+                                               "other arguments are passed on to the deploy mode")
+  parser.add_argument('-w', '--workspace', required=True, help='Workspace to plan the modules of')
+  parser.add_argument('-m', '--modules', default="", help='Comma separated list of modules to watch (default: deploy.yaml)')
+  parser.add_argument('--debounce', type=float, default=DEFAULT_DEBOUNCE,
+                      help=f'Seconds without edits before re-planning (default: {DEFAULT_DEBOUNCE})')
+  parser.add_argument('--poll', action='store_true', help='Poll for changes instead of using inotify')
+  args, deploy_args = parser.parse_known_args(argv)
+  if ',' in args.workspace or args.workspace == "all":
+    parser.error("watch runs a single workspace")
+
+  build_data_list = build_job(["-t", "plan", "-a", "true", "-c", "true", "-w", args.workspace, "-m", args.modules]
+                              + deploy_args)
+  if not build_data_list:
+    print("No modules to watch...")
+    return 1
+
+  # plans run in staging directories: the lock files init writes there are not
+  # edits, while a change of the checked in ones is
+  build_data = dict(build_data_list[0], isolate=True)
+  try:
+    asyncio.run(watch(build_data, module_dirs, args.debounce, args.poll))
+  except KeyboardInterrupt:
+    terminate_running()
+    print("Stopped watching")
+  return 0
@@ -5,9 +5,6 @@ import argparse
 import sys
 import os
 import inspect
-import hcl2
-
-from ruamel.yaml import YAML
 
 # realpath() will make your script run, even if you symlink it :)
 build_dir = os.path.realpath(os.path.abspath(os.path.split(inspect.getfile(inspect.currentframe()))[0]))
@@ -20,9 +17,21 @@ for include_dir in ["buildscripts", "variables", "main"]:
   if build_subdir not in sys.path:
     sys.path.insert(0, build_subdir)
 
-from buildscripts.tfmodules import prompt_modules, find_modules
+from buildscripts.tfaffected import affected_modules, changed_files, GitDiffError
+from buildscripts.tfconfig import load_deploy, load_workspaces
+from buildscripts.tfjournal import completed_modules, JOURNAL_DIR
+from buildscripts.tflocks import DEFAULT_LOCK_RETRIES, DEFAULT_LOCK_TIMEOUT
+from buildscripts.tfmodules import prompt_modules, find_modules, module_index
+from buildscripts.tfplan import PLAN_STORE_DIR
 from buildscripts.tfprompts import prompt_account, prompt_tfaction
-from buildscripts.tfrun import tfrun
+from buildscripts.tfrun import tfrun, tfrun_workspaces
+from buildscripts.tfserver import serve_main, submit_main
+from buildscripts.tfshard import parse_shard, shard_build_data
+from buildscripts.tfthrottle import DEFAULT_API_BUDGET
+from buildscripts.tfwatch import watch_main
+from buildscripts.tfhistory import load_durations, save_durations, HISTORY_FILE
+from buildscripts.tfresources import parse_size
+from buildscripts.tfresults import run_exit_code
 from buildscripts.tfutils import str2bool, is_empty
 
 DEPLOY_YAML_FILE     = "./deploy.yaml"
@@ -38,9 +47,10 @@ else:
   REGION = os.getenv('REGION')
 
 
-def process_arguments():
+def process_arguments(argv=None):
   """
   Parse and process program arguments
+  :param argv: arguments to parse, defaults to the command line
   :return: argument parser
   """
   parser = argparse.ArgumentParser()
@@ -71,12 +81,12 @@ def process_arguments():
   optional.add_argument('-w', '--workspace',
                         default='',
                         required=False,
-                        help='Env/Workspace')
+                        help='Env/Workspace, a comma separated list or "all" to run several workspaces concurrently')
 
   optional.add_argument('-m', '--modules',
                         default='',
                         required=False,
-                        help='List of modules')
+                        help='Comma separated list of modules, limits a deploy.yaml run to these modules')
 
   optional.add_argument('-k', '--key',
                         required=False,
@@ -84,7 +94,7 @@ def process_arguments():
 
   optional.add_argument('-b', '--branch',
                         required=False,
-                        help='Merge request branch')
+                        help='Merge request branch, compared with --base in --affected mode (default: HEAD)')
 
   optional.add_argument('-p', '--prereq',
                         default=False,
@@ -98,10 +108,163 @@ def process_arguments():
                         required=False,
                         help='Build modules using multi-threads?')
 
+  failure_mode = optional.add_mutually_exclusive_group()
+  failure_mode.add_argument('--fail-fast',
+                            dest='fail_fast',
+                            action='store_const',
+                            const=True,
+                            default=None,
+                            help='Cancel queued and running modules on the first failure (default in serial mode)')
+
+  failure_mode.add_argument('--keep-going',
+                            dest='fail_fast',
+                            action='store_const',
+                            const=False,
+                            help='Finish every module not depending on a failed one (default in concurrent mode)')
+
+  optional.add_argument('--trace',
+                        default=None,
+                        required=False,
+                        metavar='FILE',
+                        help='Write a Chrome trace of every module phase to FILE and a JSON summary next to it')
+
+  optional.add_argument('--max-workers',
+                        type=int,
+                        default=None,
+                        required=False,
+                        help='Maximum number of modules to run at the same time (default: sized from the available cores)')
+
+  optional.add_argument('--memory-budget',
+                        type=parse_size,
+                        default=None,
+                        required=False,
+                        help='Memory the terraform processes may use, e.g. 4G (default: 80%% of the memory/cgroup limit)')
+
+  optional.add_argument('--clean',
+                        type=str2bool,
+                        nargs='?',
+                        const=True,
+                        default=False,
+                        required=False,
+                        help='Remove .terraform and run a full terraform init for every module')
+
+  optional.add_argument('--changed-only',
+                        type=str2bool,
+                        nargs='?',
+                        const=True,
+                        default=False,
+                        required=False,
+                        help='Skip modules whose inputs are unchanged since their last successful run')
+
+  optional.add_argument('--preflight',
+                        type=str2bool,
+                        nargs='?',
+                        const=True,
+                        default=False,
+                        required=False,
+                        help='Check every module offline first (terraform fmt -check, init -backend=false and '
+                             'validate, all at once) and abort the run before any backend work when one fails')
+
+  optional.add_argument('--role-arn',
+                        default=os.getenv("PYRUNNER_ROLE_ARN"),
+                        required=False,
+                        help='Assume this role once and hand its credentials to every terraform process '
+                             '(default: $PYRUNNER_ROLE_ARN, else the caller credentials)')
+
+  optional.add_argument('--provider-profiles',
+                        type=str2bool,
+                        nargs='?',
+                        const=True,
+                        default=True,
+                        required=False,
+                        help='Assume the roles of the providers override once per run and hand them to terraform '
+                             'as profiles, false to let every terraform process assume them itself (default: true)')
+
+  optional.add_argument('--lock-timeout',
+                        default=DEFAULT_LOCK_TIMEOUT,
+                        required=False,
+                        help=f'How long terraform waits for a state lock held elsewhere (default: {DEFAULT_LOCK_TIMEOUT})')
+
+  optional.add_argument('--lock-retries',
+                        type=int,
+                        default=DEFAULT_LOCK_RETRIES,
+                        required=False,
+                        help=f'Times a plan/apply is retried, with backoff, when the state lock is still held '
+                             f'(default: {DEFAULT_LOCK_RETRIES})')
+
+  optional.add_argument('--api-budget',
+                        type=int,
+                        default=DEFAULT_API_BUDGET,
+                        required=False,
+                        help=f'Concurrent AWS API calls per account, split over the running modules with '
+                             f'-parallelism and lowered on throttling, 0 leaves terraform\'s default '
+                             f'(default: {DEFAULT_API_BUDGET})')
+
+  optional.add_argument('--plan-store',
+                        default=None,
+                        required=False,
+                        metavar='DIR',
+                        help=f'Save every plan to DIR, keyed by workspace, module, input hash and state serial '
+                             f'(default for --from-plans: {PLAN_STORE_DIR})')
+
+  optional.add_argument('--from-plans',
+                        type=str2bool,
+                        nargs='?',
+                        const=True,
+                        default=False,
+                        required=False,
+                        help='Apply the plans saved by an earlier plan run instead of planning again, '
+                             'modules whose inputs or state changed since are rejected')
+
+  optional.add_argument('--resume',
+                        type=str2bool,
+                        nargs='?',
+                        const=True,
+                        default=False,
+                        required=False,
+                        help=f'Deploy mode: skip the modules the last run of the action completed (see {JOURNAL_DIR}) '
+                             'when their sources did not change, and carry on from where it stopped')
+
+  optional.add_argument('--shard',
+                        type=parse_shard,
+                        default=None,
+                        required=False,
+                        metavar='I/N',
+                        help='Deploy mode: only run shard I of N, balanced on the --durations file (module counts '
+                             'without it). Plans are split module by module; applies keep the modules linked by '
+                             'remote state on one shard, a fully connected estate ends up on a single shard')
+
+  optional.add_argument('--durations',
+                        default=None,
+                        required=False,
+                        metavar='FILE',
+                        help='Expected module durations --shard balances on, give every runner the same file')
+
+  optional.add_argument('--save-durations',
+                        default=None,
+                        required=False,
+                        metavar='FILE',
+                        help=f'Write the expected module durations of the action from {HISTORY_FILE} to FILE '
+                             'for --durations, and exit')
+
+  optional.add_argument('--affected',
+                        type=str2bool,
+                        nargs='?',
+                        const=True,
+                        default=False,
+                        required=False,
+                        help='Deploy mode: only run the modules affected by the changes of --branch since --base, '
+                             'and the modules reading their state')
+
+  optional.add_argument('--base',
+                        default='origin/main',
+                        required=False,
+                        help='Base ref the --branch changes are compared with in --affected mode')
+
 
   parser._action_groups.append(optional)
 
-  return parser.parse_args()
+  return parser.parse_args(argv)
 
 
 def parse_envs_file(envs_file):
@@ -109,23 +272,18 @@ def parse_envs_file(envs_file):
   The envs.tf file contains metadata that required to build an
   environment for a specific workspace
   :param envs_file:
-  :return: list of workspaces and workspace data dict
+  :return: list of workspaces to display and dict of workspace -> Workspace
   """
-  with(open(envs_file, 'r')) as env_file:
-    env_dict = hcl2.load(env_file)
-  workspaces_dict = env_dict['variable'][0]['envs']['default']
+  workspaces_dict = load_workspaces(envs_file)
 
   # setup the workspace/account to display and prompt user to select one to build
-  workspaces = []
-  for workspace in workspaces_dict:
-    for key, val in workspace.items():
-      workspaces.append(key + "|" + val['account_id'] + "|" + val ['account'])
+  workspaces = [w.describe() for w in workspaces_dict.values()]
   return workspaces, workspaces_dict
 
 
 def setup_build_data(build_workspace, args, mod, workspaces_dict, deploy=False, deploy_action=None):
 
-  build_env = workspaces_dict[0][build_workspace]
+  build_env = workspaces_dict[build_workspace]
 
   if not str2bool(args.deploy):
     # auto-approve set to True in non-interactive mode
@@ -138,36 +296,177 @@ def setup_build_data(build_workspace, args, mod, workspaces_dict, deploy=False,
   else:
     tfaction = args.tfaction
 
+  if args.from_plans and not tfaction.startswith("apply"):
+    print("Arguments ERROR: --from-plans applies saved plans, use it with apply or apply-destroy")
+    exit(1)
+
   build_data = {
     "workspace": build_workspace,
     "modules": mod,
     "auto_approve": auto_approve,
     "deploy": args.deploy,
     "tfaction": tfaction,
-    "environment": build_env,
-    "bucket_region": workspaces_dict[0][build_workspace]["bucket_region"],
-    "bucket": workspaces_dict[0][build_workspace]["bucket"],
-    "dynamodb": workspaces_dict[0][build_workspace]["dynamodb"],
-    "multi_thread": args.concurrent
+    "environment": build_env.settings,
+    "bucket_region": build_env.bucket_region,
+    "bucket": build_env.bucket,
+    "dynamodb": build_env.dynamodb,
+    "multi_thread": args.concurrent,
+    "clean": args.clean,
+    "changed_only": args.changed_only,
+    "max_workers": args.max_workers,
+    "memory_budget": args.memory_budget,
+    "fail_fast": args.fail_fast,
+    "trace": args.trace,
+    "role_arn": args.role_arn,
+    "provider_profiles": args.provider_profiles,
+    "envs": dict((name, workspace.settings) for name, workspace in workspaces_dict.items()),
+    "lock_timeout": args.lock_timeout,
+    "lock_retries": args.lock_retries,
+    "api_budget": args.api_budget,
+    "preflight": args.preflight,
+    "plan_store": args.plan_store or (PLAN_STORE_DIR if args.from_plans else None),
+    "from_plans": args.from_plans
   }
 
   return build_data
 
 
 def get_deploy_data():
-  src = YAML(typ='safe')
-  with open(DEPLOY_YAML_FILE) as f:
-    deploy_data = src.load(f)
-  return deploy_data
+  return load_deploy(DEPLOY_YAML_FILE)
+
+
+def get_deploy_workspaces(deploy_data):
+  """
+  deploy.yaml lists every workspace as a single key dict, merge them
+  :param deploy_data: parsed deploy.yaml
+  :return: dict of workspace -> deploy settings
+  """
+  deploy_workspaces = {}
+  for entry in deploy_data["workspace"]:
+    deploy_workspaces.update(entry)
+  return deploy_workspaces
+
+
+def deploy_build_data(args):
+  """
+  Work out the workspaces and modules of a deploy.yaml run
+  :param args: parsed arguments
+  :return: list of build_data, one per workspace with modules to run
+  """
+  if is_empty(args.tfaction) or is_empty(args.workspace):
+    print ("Arguments ERROR: both TF action and workspace are required in using deploy.yaml")
+    exit(1)
+
+  deploy_workspaces = get_deploy_workspaces(get_deploy_data())
+  if args.workspace == "all":
+    build_workspaces = list(deploy_workspaces)
+  else:
+    build_workspaces = [w.strip() for w in args.workspace.split(',') if w.strip()]
+
+  for build_workspace in build_workspaces:
+    if build_workspace not in deploy_workspaces:
+      print(f"Arguments ERROR: workspace {build_workspace} is not defined in {DEPLOY_YAML_FILE}")
+      exit(1)
+
+  _, workspaces_dict = parse_envs_file(INPUT_ENVS_FILE)
+  for build_workspace in build_workspaces:
+    if build_workspace not in workspaces_dict:
+      print(f"Arguments ERROR: workspace {build_workspace} is not defined in {INPUT_ENVS_FILE}")
+      exit(1)
+
+  requested_modules = [os.path.normpath(m.strip()) for m in args.modules.split(',') if m.strip()]
+
+  if args.affected:
+    try:
+      affected_files = changed_files(args.base, args.branch)
+    except GitDiffError as error:
+      print(f"Unable to work out the affected modules: {error}")
+      exit(1)
+    print(f"{len(affected_files)} file(s) changed on {args.branch or 'HEAD'} since {args.base}")
+    modules_index = module_index(MODULE_DIRS)
+
+  build_data_list = []
+  for build_workspace in build_workspaces:
+    build_modules = list(deploy_workspaces[build_workspace]['modules'])
+    if requested_modules:
+      build_modules = [m for m in build_modules if os.path.normpath(m) in requested_modules]
+    if args.affected:
+      build_modules = affected_modules(affected_files, modules_index, build_workspace, build_modules)
+
+    if build_workspace != "sre":
+      for module in MODULES_FOR_SRE_ONLY:
+        if module in build_modules:
+          build_modules.remove(module)
+
+    # only run ses-setup in these workspaces below
+    if build_workspace != "sre":
+      for module in EMAIL_SETUP_ONLY:
+        if module in build_modules:
+          print(f"Email setup module is build in SRE only: {module}")
+          build_modules.remove(module)
+
+    if len(build_modules) > 0:
+      print(f"\n******* Modules to run in {build_workspace}:  *********")
+      print("\n".join([m for m in build_modules]))
+      print("**********************************")
+      build_data_list.append(setup_build_data(build_workspace, args, build_modules, workspaces_dict, True, args.tfaction))
+
+  if args.shard:
+    durations = None
+    if args.durations:
+      if not os.path.exists(args.durations):
+        print(f"Arguments ERROR: --durations file {args.durations} not found")
+        exit(1)
+      durations = load_durations(args.tfaction, args.durations)
+    else:
+      print("WARNING: --shard without --durations, every module is expected to take as long as any other")
+    build_data_list, loads = shard_build_data(build_data_list, args.shard, durations)
+    print(f"\n******* Shard {args.shard[0]}/{args.shard[1]} (estimated "
+          f"{loads[args.shard[0] - 1]:.1f}s of {', '.join(f'{l:.1f}s' for l in loads)}):  *********")
+    for build_data in build_data_list:
+      print("\n".join(f"{build_data['workspace']}: {m}" for m in build_data["modules"]))
+    print("**********************************")
+
+  if args.resume and build_data_list:
+    run_id, completed = completed_modules(args.tfaction)
+    if run_id is None:
+      print(f"No earlier {args.tfaction} run to resume, running every module")
+    else:
+      print(f"Resuming {args.tfaction} run {run_id}")
+    for build_data in build_data_list:
+      build_data["resume"] = completed.get(build_data["workspace"], {})
+
+  return build_data_list
+
+
+def build_job(argv):
+  """
+  Build data of a job submitted to `pyrunner.py serve`
+  :param argv: deploy mode arguments of the job
+  :return: list of build_data
+  """
+  return deploy_build_data(process_arguments(["--deploy", "true"] + list(argv)))
 
 
 def main():
 
+  if len(sys.argv) > 1 and sys.argv[1] == "serve":
+    exit(serve_main(sys.argv[2:], build_job))
+  if len(sys.argv) > 1 and sys.argv[1] == "submit":
+    exit(submit_main(sys.argv[2:]))
+  if len(sys.argv) > 1 and sys.argv[1] == "watch":
+    exit(watch_main(sys.argv[2:], build_job, MODULE_DIRS))
+
   args = process_arguments()
   modules_to_plan = []
   build_data = {}
   print (f"Parameters passed to orchestrators:---> tfaction: {args.tfaction}, deploy: {args.deploy}, branch {args.branch}, modules: {args.modules}, pre-req: {args.prereq}, concurrent: {args.concurrent}")
 
+  if args.save_durations:
+    count = save_durations(args.tfaction, args.save_durations)
+    print(f"Expected durations of {count} module(s) written to {args.save_durations}")
+    exit(0)
+
   if not str2bool(args.deploy):
     print ("running in interactive mode")
     workspaces, workspaces_dict = parse_envs_file(INPUT_ENVS_FILE)
@@ -213,38 +512,15 @@ def main():
       print("\n".join([m for m in build_modules]))
       print("**********************************")
       build_data = setup_build_data(build_workspace, args, build_modules, workspaces_dict)
-      tfrun(build_data)
+      results = tfrun(build_data)
+      exit(run_exit_code({build_workspace: results}))
 
   else:
     # running in non interactive mode using deploy.yaml file
-
-    if is_empty(args.tfaction) or is_empty(args.workspace):
-      print ("Arguments ERROR: both TF action and workspace are required in using deploy.yaml")
-      exit(1)
-
-    deploy_data = get_deploy_data()
-    build_modules = deploy_data["workspace"][0][args.workspace]['modules']
-    _, workspaces_dict = parse_envs_file(INPUT_ENVS_FILE)
-
-    if args.workspace != "sre":
-      for module in MODULES_FOR_SRE_ONLY:
-        if module in build_modules:
-          build_modules.remove(module)
-
-    # only run ses-setup in these workspaces below
-    if args.workspace != "sre":
-      for module in EMAIL_SETUP_ONLY:
-        if module in build_modules:
-          print(f"Email setup module is build in SRE only: {module}")
-          build_modules.remove(module)
-
-    build_data = setup_build_data(args.workspace, args, build_modules, workspaces_dict, True, args.tfaction)
-
-    if len(build_modules) > 0:
-      print("\n******* Modules to run:  *********")
-      print("\n".join([m for m in build_modules]))
-      print("**********************************")
-      tfrun(build_data)
+    build_data_list = deploy_build_data(args)
+    if len(build_data_list) > 0:
+      exit(run_exit_code(tfrun_workspaces(build_data_list)))
+    print("No modules to run...")
 
 
 if __name__ == '__main__':
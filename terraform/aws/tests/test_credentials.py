@@ -0,0 +1,70 @@
+import datetime
+import os
+import tempfile
+import threading
+import unittest
+
+from buildscripts import tfcredentials
+from buildscripts.tfcredentials import profile_name, profile_override, provider_roles, CredentialBroker
+
+ENVS = {
+  "dev": {"workspace_iam_role": "arn:aws:iam::555555555555:role/administrators",
+          "share_r53_iam_role": "arn:aws:iam::111111111111:role/administrators"},
+  "sre": {"share_sre_iam_role": "arn:aws:iam::222222222222:role/administrators"},
+}
+
+
+class FakeSts:
+  def __init__(self):
+    self.calls = []
+    self.lock = threading.Lock()
+
+  def assume_role(self, RoleArn, RoleSessionName, DurationSeconds):
+    with self.lock:
+      self.calls.append(RoleArn)
+    expiration = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=DurationSeconds)
+    return {"Credentials": {"AccessKeyId": f"AK{len(self.calls)}", "SecretAccessKey": "secret", "SessionToken": "token",
+                            "Expiration": expiration}}
+
+
+class ProviderProfilesTest(unittest.TestCase):
+  def setUp(self):
+    with open(os.path.join("variables", "config", "providers_override.tf"), 'r') as f:
+      self.override_text = f.read()
+    self.credentials_dir = tempfile.TemporaryDirectory()
+    self.saved_dir = tfcredentials.CREDENTIALS_DIR
+    tfcredentials.CREDENTIALS_DIR = self.credentials_dir.name
+
+  def tearDown(self):
+    tfcredentials.CREDENTIALS_DIR = self.saved_dir
+    self.credentials_dir.cleanup()
+
+  def test_roles_of_the_override(self):
+    self.assertEqual(provider_roles(self.override_text, "dev", ENVS),
+                     [ENVS["dev"]["workspace_iam_role"], ENVS["dev"]["share_r53_iam_role"],
+                      ENVS["sre"]["share_sre_iam_role"]])
+
+  def test_unknown_role_expression(self):
+    self.assertIsNone(provider_roles('provider "aws" {\n  assume_role {\n    role_arn = var.role\n  }\n}\n', "dev", ENVS))
+
+  def test_override_uses_profiles(self):
+    override = profile_override(self.override_text)
+    self.assertNotIn("assume_role", override)
+    self.assertEqual(override.count('profile = "pyrunner-${replace('), 3)
+
+  def test_every_role_assumed_once_for_every_process(self):
+    sts = FakeSts()
+    broker = CredentialBroker(lambda: sts)
+    roles = provider_roles(self.override_text, "dev", ENVS)
+    envs = [broker.profiles_env(roles, base_env={}) for _ in range(5)]
+    self.assertEqual(sorted(sts.calls), sorted(roles))
+    credentials_file = envs[0]["AWS_SHARED_CREDENTIALS_FILE"]
+    self.assertEqual(os.stat(credentials_file).st_mode & 0o777, 0o600)
+    with open(credentials_file, 'r') as f:
+      content = f.read()
+    for role_arn in roles:
+      self.assertIn(f"[{profile_name(role_arn)}]", content)
+
+
+if __name__ == '__main__':
+  unittest.main()
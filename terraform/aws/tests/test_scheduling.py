@@ -0,0 +1,68 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+from buildscripts import tfrun
+from buildscripts.tfresources import AdmissionController
+from buildscripts.tfresults import ModuleResult, SUCCEEDED
+
+
+class CriticalPathFirstTest(unittest.TestCase):
+  """
+  With a single worker the modules have to start in critical path order,
+  not in the order their tasks were created in
+  """
+  def setUp(self):
+    # the run history of the build directory is not read
+    self.curr_path = os.getcwd()
+    self.build_dir = tempfile.TemporaryDirectory()
+    os.chdir(self.build_dir.name)
+    self.run_module = tfrun.run_module
+    self.expected_durations = tfrun.expected_durations
+    self.started = []
+
+    async def run_module(module_path, build_data):
+      self.started.append(module_path)
+      await asyncio.sleep(0.01)
+      return ModuleResult(build_data["workspace"], module_path, SUCCEEDED)
+    tfrun.run_module = run_module
+
+  def tearDown(self):
+    tfrun.run_module = self.run_module
+    tfrun.expected_durations = self.expected_durations
+    os.chdir(self.curr_path)
+    self.build_dir.cleanup()
+
+  def run_graph(self, order, deps, durations):
+    tfrun.expected_durations = lambda tfaction: dict((("dev", m), d) for m, d in durations.items())
+    build_data = {"workspace": "dev", "tfaction": "plan", "multi_thread": True}
+    results = {}
+
+    async def run():
+      limiter = AdmissionController(max_workers=1)
+      try:
+        await tfrun.run_graph(order, deps, build_data, limiter, asyncio.Event(), results)
+      finally:
+        limiter.close()
+    asyncio.run(run())
+    return results
+
+  def test_chain_before_independent_module(self):
+    order = ["./main/m0000", "./main/m0001", "./main/m0003", "./main/m0004", "./main/m0005"]
+    deps = {"./main/m0000": set(), "./main/m0001": {"./main/m0000"}, "./main/m0003": {"./main/m0001"},
+            "./main/m0004": {"./main/m0003"}, "./main/m0005": set()}
+    durations = {"./main/m0000": 60, "./main/m0001": 60, "./main/m0003": 60, "./main/m0004": 60, "./main/m0005": 10}
+    results = self.run_graph(order, deps, durations)
+    self.assertEqual(self.started, order)
+    self.assertTrue(all(r.status == SUCCEEDED for r in results.values()))
+
+  def test_longest_chain_first_whatever_the_deploy_order(self):
+    order = ["./main/single", "./main/head", "./main/tail"]
+    deps = {"./main/single": set(), "./main/head": set(), "./main/tail": {"./main/head"}}
+    self.run_graph(order, deps, {"./main/single": 10, "./main/head": 20, "./main/tail": 20})
+    self.assertEqual(self.started, ["./main/head", "./main/tail", "./main/single"])
+
+
+if __name__ == '__main__':
+  unittest.main()
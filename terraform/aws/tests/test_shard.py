@@ -0,0 +1,31 @@
+import unittest
+
+from buildscripts.tfshard import connected_components, shard_build_data
+
+
+def build_data(tfaction, modules):
+  return {"workspace": "dev", "tfaction": tfaction, "modules": modules}
+
+
+class ShardTest(unittest.TestCase):
+  def test_plans_split_module_by_module(self):
+    modules = ["./main/vpc", "./main/sg", "./main/devops", "./main/kms"]
+    durations = dict((("dev", m), d) for m, d in zip(modules, [40, 30, 20, 10]))
+    shards = [shard_build_data([build_data("plan", modules)], (i, 2), durations) for i in (1, 2)]
+    self.assertEqual(shards[0][0][0]["modules"], ["./main/vpc", "./main/kms"])
+    self.assertEqual(shards[1][0][0]["modules"], ["./main/sg", "./main/devops"])
+    self.assertEqual(shards[0][1], [50, 50])
+
+  def test_every_runner_computes_the_same_split(self):
+    modules = [f"./main/m{i}" for i in range(7)]
+    splits = [shard_build_data([build_data("plan-destroy", modules)], (1, 3))[0] for _ in range(2)]
+    self.assertEqual(splits[0], splits[1])
+
+  def test_connected_modules_stay_together(self):
+    modules = ["./main/vpc", "./main/sg", "./main/devops", "./main/kms"]
+    deps = {"./main/sg": {"./main/vpc"}, "./main/devops": {"./main/sg"}}
+    self.assertEqual(connected_components(modules, deps), [["./main/vpc", "./main/sg", "./main/devops"], ["./main/kms"]])
+
+
+if __name__ == '__main__':
+  unittest.main()
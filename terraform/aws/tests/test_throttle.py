@@ -0,0 +1,41 @@
+import unittest
+
+from buildscripts.tfthrottle import throttled
+
+# a throttled apply as terraform prints it on a terminal, and without colours
+COLOURED_ERROR = [
+  "\x1b[31m╷\x1b[0m\x1b[0m",
+  "\x1b[31m│\x1b[0m \x1b[0m\x1b[1m\x1b[31mError: \x1b[0m\x1b[0m\x1b[1mcreating EC2 Instance: operation error EC2: RunInstances, "
+  "https response error StatusCode: 400, RequestID: 5c9d, api error RequestLimitExceeded: Request limit exceeded.\x1b[0m",
+  "\x1b[31m│\x1b[0m \x1b[0m",
+  "\x1b[31m│\x1b[0m \x1b[0m\x1b[0m  with aws_instance.this,",
+  "\x1b[31m╵\x1b[0m\x1b[0m",
+]
+PLAIN_ERROR = ["╷", "│ Error: reading S3 Bucket (b): operation error S3: HeadBucket,",
+               "│ exceeded maximum number of attempts, 3, https response error StatusCode: 503, RequestID: x", "╵"]
+
+
+class ThrottledTest(unittest.TestCase):
+  def test_coloured_error(self):
+    self.assertTrue(throttled(COLOURED_ERROR))
+
+  def test_wrapped_plain_error(self):
+    self.assertTrue(throttled(PLAIN_ERROR))
+
+  def test_sdk_v1_error(self):
+    self.assertTrue(throttled(["\x1b[1m\x1b[31mError: \x1b[0m\x1b[0m\x1b[1mThrottlingException: Rate exceeded\x1b[0m"]))
+
+  def test_plan_output_is_not_an_error(self):
+    self.assertFalse(throttled([
+      "  \x1b[32m+\x1b[0m\x1b[0m name = \"Throttling-alarm\"",
+      "aws_cloudwatch_metric_alarm.throttling: Refreshing state... [id=SlowDown]",
+      "StatusCode: 429 in an output value",
+    ]))
+
+  def test_other_error(self):
+    self.assertFalse(throttled(["\x1b[31m│\x1b[0m \x1b[0m\x1b[1m\x1b[31mError: \x1b[0m\x1b[0m\x1b[1mInvalid reference\x1b[0m",
+                                "\x1b[31m│\x1b[0m   on main.tf line 3: RequestLimitExceeded"]))
+
+
+if __name__ == '__main__':
+  unittest.main()